@@ -0,0 +1,148 @@
+# Simulación de partidas en lote, sin ventana ni audio, para equilibrar la IA.
+#
+# Ejemplo:
+#   python batch_sim.py --games 2000 --policy hunter --set enemy.max_pump=4 -o runs.csv
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+
+# Columnas de la salida, una fila por partida
+COLUMNS = ["seed", "result", "ticks", "score", "enemies_defeated", "lives_lost",
+           "astar_calls", "astar_searches", "flow_rebuilds"]
+
+# Políticas del jugador automático
+def random_policy(game, rng):
+    return rng.choice((main.INPUT_LEFT, main.INPUT_RIGHT, main.INPUT_UP,
+                       main.INPUT_DOWN, main.INPUT_PUMP, 0))
+
+def hunter_policy(game, rng):
+    # Bombear si hay un enemigo adyacente; si no, acercarse al más cercano
+    player = game.player
+    if not game.enemies:
+        return random_policy(game, rng)
+    target = min(game.enemies, key=lambda e: abs(e.grid_x - player.grid_x) + abs(e.grid_y - player.grid_y))
+    dx = target.grid_x - player.grid_x
+    dy = target.grid_y - player.grid_y
+    if abs(dx) <= 1 and abs(dy) <= 1:
+        return main.INPUT_PUMP
+    if rng.random() < 0.2:
+        return random_policy(game, rng)
+    if abs(dx) >= abs(dy):
+        return main.INPUT_RIGHT if dx > 0 else main.INPUT_LEFT
+    return main.INPUT_DOWN if dy > 0 else main.INPUT_UP
+
+POLICIES = {"random": random_policy, "hunter": hunter_policy}
+
+def parse_value(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+def parse_settings(pairs):
+    # "game.enemy_spawn_delay=8000" -> {"game": {"enemy_spawn_delay": 8000}}
+    settings = {"game": {}, "player": {}, "enemy": {}}
+    for pair in pairs:
+        key, value = pair.split("=", 1)
+        scope, name = key.split(".", 1)
+        if scope not in settings:
+            raise ValueError(f"Ámbito desconocido: {scope} (usa game, player o enemy)")
+        settings[scope][name] = parse_value(value)
+    return settings
+
+def run_game(seed, policy, settings, max_ticks):
+    # El jugador automático usa su propio generador para no alterar el de la partida
+    rng = random.Random(seed)
+    
+    game = main.Game(headless=True)
+    for name, value in settings["game"].items():
+        setattr(game, name, value)
+    game.player_settings = settings["player"]
+    game.enemy_settings = settings["enemy"]
+    
+    game.start(seed)
+    lives = game.player.lives
+    controller = POLICIES[policy]
+    result = game.simulate(lambda g: controller(g, rng), max_ticks)
+    
+    cache = game.grid.path_cache
+    return {
+        "seed": seed,
+        "result": result.name,
+        "ticks": game.ticks,
+        "score": game.player.score,
+        "enemies_defeated": game.enemies_defeated,
+        "lives_lost": lives - game.player.lives,
+        "astar_calls": cache.hits + cache.misses,
+        "astar_searches": cache.misses,
+        "flow_rebuilds": game.player.flow_field.rebuilds,
+    }
+
+def _run_game_args(args):
+    return run_game(*args)
+
+def run_batch(seeds, policy="hunter", settings=None, max_ticks=60 * main.FPS * 5, workers=None):
+    settings = settings or parse_settings([])
+    jobs = [(seed, policy, settings, max_ticks) for seed in seeds]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(_run_game_args, jobs, chunksize=max(1, len(jobs) // 64)))
+    # Resultados por columnas
+    return {column: [row[column] for row in rows] for column in COLUMNS}
+
+def write_csv(columns, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(zip(*(columns[c] for c in COLUMNS)))
+
+def write_npz(columns, path):
+    import numpy as np  # Opcional: solo hace falta para este formato
+    np.savez_compressed(path, **{c: np.asarray(columns[c]) for c in COLUMNS})
+
+def summarize(columns):
+    games = len(columns["seed"])
+    lines = [f"Partidas: {games}"]
+    for result in ("WIN", "GAME_OVER", "GAME"):
+        count = columns["result"].count(result)
+        lines.append(f"  {result}: {count} ({100 * count / games:.1f}%)")
+    for column in COLUMNS[2:]:
+        values = columns[column]
+        lines.append(f"  {column}: media {sum(values) / games:.1f}, min {min(values)}, max {max(values)}")
+    return "\n".join(lines)
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Simula partidas de Dig Dug en paralelo")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0, help="Semilla de la primera partida")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="hunter")
+    parser.add_argument("--max-ticks", type=int, default=60 * main.FPS * 5)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--set", action="append", default=[], metavar="ÁMBITO.ATRIBUTO=VALOR",
+                        help="Ajuste a probar, p. ej. game.pooka_ratio=0.5, enemy.move_delay=200 "
+                             "o game.path_planner=dstar")
+    parser.add_argument("-o", "--output", help="Fichero .csv o .npz con una fila por partida")
+    args = parser.parse_args(argv)
+    
+    start = time.perf_counter()
+    columns = run_batch(range(args.seed, args.seed + args.games), args.policy,
+                        parse_settings(args.set), args.max_ticks, args.workers)
+    elapsed = time.perf_counter() - start
+    
+    if args.output:
+        if args.output.endswith(".npz"):
+            write_npz(columns, args.output)
+        else:
+            write_csv(columns, args.output)
+    print(summarize(columns))
+    print(f"{args.games} partidas en {elapsed:.1f} s ({60 * args.games / elapsed:.0f} por minuto)")
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
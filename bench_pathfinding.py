@@ -0,0 +1,241 @@
+# Pruebas de rendimiento de AStar (y de HPAStar) sobre mapas sintéticos con semilla fija.
+#
+# Ejemplos:
+#   python bench_pathfinding.py -o base.json            # medir y guardar
+#   python bench_pathfinding.py --compare base.json     # comparar con otra medida
+#   python bench_pathfinding.py --quick                 # solo mapas pequeños
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import main
+
+SIZES = [(25, 19), (50, 50), (100, 100), (250, 250), (500, 500)]
+QUICK_SIZES = SIZES[:3]
+ROCK_DENSITIES = [0.05, 0.2]
+TUNNEL_RATIOS = [0.0, 0.5]
+
+def make_grid(width, height, rock_density, tunnel_ratio, seed):
+    # Mapa aleatorio: cada celda es roca, túnel o tierra según las proporciones
+    rng = random.Random(seed)
+    cells = bytearray(width * height)
+    for i in range(len(cells)):
+        r = rng.random()
+        if r < rock_density:
+            cells[i] = 2
+        elif r < rock_density + (1 - rock_density) * tunnel_ratio:
+            cells[i] = 1
+    grid = main.Grid(random.Random(seed), width, height)
+    grid.load(cells)
+    return grid
+
+def random_free_cell(grid, rng):
+    while True:
+        x, y = rng.randrange(grid.width), rng.randrange(grid.height)
+        if not grid.is_rock(x, y):
+            return x, y
+
+def wall_in(grid, cell):
+    # Rodear la celda de rocas: el objetivo queda inalcanzable
+    x, y = cell
+    cells = bytearray(grid.cells)
+    for nx, ny in ((x, y - 1), (x + 1, y), (x, y + 1), (x - 1, y)):
+        if grid.is_valid_position(nx, ny):
+            cells[ny * grid.width + nx] = 2
+    grid.load(cells)
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(name, pathfinder, queries, **limits):
+    latencies = []
+    nodes = []
+    for start, goal in queries:
+        started = time.perf_counter()
+        pathfinder.search(start, goal, **limits)
+        latencies.append((time.perf_counter() - started) * 1000)
+        nodes.append(pathfinder.nodes_expanded)
+    latencies.sort()
+    return {
+        "name": name,
+        "queries": len(queries),
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "mean_nodes": sum(nodes) / len(nodes),
+    }
+
+def measure_peak_memory(name, pathfinder, queries):
+    # Pico de memoria de cada búsqueda en bytes sobre lo que había antes, según
+    # tracemalloc. No es el número de reservas: lo que se libera durante la
+    # búsqueda (p. ej. las entradas del montículo) no suma. La primera
+    # búsqueda prepara las estructuras que se reutilizan y no se cuenta.
+    pathfinder.search(*queries[0])
+    peaks = []
+    tracemalloc.start()
+    for start, goal in queries:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        pathfinder.search(start, goal)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return {"name": name, "queries": len(queries), "peak_kib": sum(peaks) / len(peaks) / 1024}
+
+def measure_neighbors(name, pathfinder, grid, rng, calls=20000):
+    cells = [random_free_cell(grid, rng) for _ in range(calls)]
+    started = time.perf_counter()
+    for cell in cells:
+        pathfinder.get_neighbors(cell)
+    elapsed = time.perf_counter() - started
+    return {"name": name, "queries": calls, "ns_per_call": elapsed * 1e9 / calls}
+
+def measure_replanning(name, grid, rng, steps, goal_move_rate):
+    # Persecución simulada: el enemigo avanza por su camino, el objetivo da un
+    # paso con probabilidad `goal_move_rate` y se excava una celda por paso.
+    # Se compara A* desde cero con el planificador incremental.
+    original = bytearray(grid.cells)
+    events = []
+    start, goal = random_free_cell(grid, rng), random_free_cell(grid, rng)
+    for _ in range(steps):
+        events.append((rng.random() < goal_move_rate, rng.random(), random_free_cell(grid, rng)))
+
+    totals = {}
+    for kind in ("astar", "dstar"):
+        grid.load(original)
+        pathfinder = main.AStar(grid) if kind == "astar" else main.DStarLite(grid)
+        s, t = start, goal
+        nodes = 0
+        elapsed = 0.0
+        for move_goal, choice, dig in events:
+            started = time.perf_counter()
+            if kind == "astar":
+                path = pathfinder.search(s, t)
+                nodes += pathfinder.nodes_expanded
+            else:
+                path = pathfinder.plan(s, t)
+            elapsed += time.perf_counter() - started
+            if path and len(path) > 1:
+                s = path[1]
+            if move_goal:
+                options = grid.neighbor_cells[grid.index(*t)]
+                if options:
+                    t = options[int(choice * len(options))]
+            grid.dig(*dig)
+        if kind == "dstar":
+            nodes = pathfinder.nodes_expanded
+        totals[kind] = (elapsed * 1000, nodes)
+    grid.load(original)
+    return {
+        "name": name,
+        "queries": steps,
+        "astar_ms": totals["astar"][0],
+        "dstar_ms": totals["dstar"][0],
+        "astar_nodes": totals["astar"][1],
+        "dstar_nodes": totals["dstar"][1],
+    }
+
+def queries_for(width, height, budget):
+    # Menos búsquedas en mapas grandes para que el total sea razonable
+    return max(3, budget * 25 * 19 // (width * height))
+
+def run(sizes, seed, budget):
+    results = []
+    for width, height in sizes:
+        for rock_density in ROCK_DENSITIES:
+            for tunnel_ratio in TUNNEL_RATIOS:
+                label = f"{width}x{height}/rocas={rock_density}/tuneles={tunnel_ratio}"
+                grid = make_grid(width, height, rock_density, tunnel_ratio, seed)
+                pathfinder = main.AStar(grid)
+                rng = random.Random(seed)
+                count = queries_for(width, height, budget)
+
+                queries = [(random_free_cell(grid, rng), random_free_cell(grid, rng))
+                           for _ in range(count)]
+                results.append(measure(f"find_path/aleatorio/{label}", pathfinder, queries))
+                if width * height <= 100 * 100:
+                    results.append(measure_peak_memory(f"pico-memoria/aleatorio/{label}",
+                                                       pathfinder, queries))
+                # Búsqueda acotada con el mejor camino parcial (p. ej. huir)
+                results.append(measure(f"find_path/acotado-500/{label}", pathfinder, queries,
+                                       max_expansions=500, partial=True))
+                # A* jerárquico: las primeras búsquedas construyen los clústeres
+                results.append(measure(f"hpa/aleatorio/{label}", main.HPAStar(grid), queries))
+                results.append(measure_neighbors(f"get_neighbors/{label}", pathfinder, grid, rng))
+                if width * height <= 100 * 100:
+                    results.append(measure_replanning(f"replanificar/objetivo-fijo/{label}",
+                                                      grid, rng, 100, 0.0))
+                    results.append(measure_replanning(f"replanificar/objetivo-movil/{label}",
+                                                      grid, rng, 100, 0.5))
+
+                # Peor caso: el objetivo está encerrado. Sin las zonas conexas A*
+                # recorría todo el mapa; ahora se descarta antes de buscar.
+                goal = random_free_cell(grid, rng)
+                wall_in(grid, goal)
+                starts = [random_free_cell(grid, rng) for _ in range(max(3, count // 10))]
+                queries = [(start, goal) for start in starts if start != goal]
+                results.append(measure(f"find_path/inalcanzable/{label}", pathfinder, queries))
+                results.append(measure(f"hpa/inalcanzable/{label}", main.HPAStar(grid), queries))
+                print(f"  {label}", file=sys.stderr)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_table(results, baseline=None):
+    previous = {r["name"]: r for r in (baseline or {}).get("results", [])}
+    for result in results:
+        if "p50_ms" in result:
+            line = (f"{result['name']:<60} p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms"
+                    f"  nodos {result['mean_nodes']:10.1f}")
+            key = "p50_ms"
+        elif "dstar_ms" in result:
+            line = (f"{result['name']:<60} A* {result['astar_ms']:9.1f} ms / {result['astar_nodes']} nodos"
+                    f"  D* Lite {result['dstar_ms']:9.1f} ms / {result['dstar_nodes']} nodos")
+            key = "dstar_ms"
+        elif "peak_kib" in result:
+            line = f"{result['name']:<60} {result['peak_kib']:9.1f} KiB/búsqueda (pico)"
+            key = "peak_kib"
+        else:
+            line = f"{result['name']:<60} {result['ns_per_call']:9.1f} ns/llamada"
+            key = "ns_per_call"
+        old = previous.get(result["name"])
+        if old and old.get(key):
+            line += f"  x{old[key] / result[key]:.2f} vs base"
+        print(line)
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Rendimiento de AStar en mapas sintéticos")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--queries", type=int, default=200, help="Búsquedas en el mapa de 25x19")
+    parser.add_argument("--quick", action="store_true", help="Solo mapas de hasta 100x100")
+    parser.add_argument("-o", "--output", help="Guardar los resultados en JSON")
+    parser.add_argument("--compare", help="JSON de una medida anterior para comparar")
+    args = parser.parse_args(argv)
+
+    results = run(QUICK_SIZES if args.quick else SIZES, args.seed, args.queries)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
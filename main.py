@@ -1,15 +1,21 @@
+import time
+STARTUP_TIME = time.perf_counter()  # Para medir el tiempo hasta el primer frame
+
 import pygame
 import sys
 import os
 import random
 import math
+import gc
+import json
 from enum import Enum
 import heapq
-from collections import deque
-
-# Inicialización de Pygame
-pygame.init()
-pygame.mixer.init()
+import struct
+import threading
+import zlib
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from itertools import islice
 
 # Constantes
 TILE_SIZE = 32
@@ -18,6 +24,8 @@ GRID_HEIGHT = 19
 WIDTH = TILE_SIZE * GRID_WIDTH
 HEIGHT = TILE_SIZE * GRID_HEIGHT
 FPS = 60
+TICK_MS = 1000 / FPS  # Paso fijo de la simulación
+MAX_STEPS_PER_FRAME = 5  # Pasos de lógica como máximo por frame dibujado
 
 # Colores
 BLACK = (0, 0, 0)
@@ -29,10 +37,54 @@ GREEN = (0, 255, 0)
 BLUE = (0, 0, 255)
 ORANGE = (255, 165, 0)
 
-# Configuración de la pantalla
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Dig Dug con IA")
-clock = pygame.time.Clock()
+# Entradas del jugador como máscara de bits, leídas del teclado o de un guion
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_UP = 4
+INPUT_DOWN = 8
+INPUT_PUMP = 16
+
+# Pantalla y reloj: se crean en init_pygame() y open_window() para poder
+# importar el módulo (y simular partidas) sin ventana ni tarjeta de sonido
+screen = None
+clock = None
+
+def init_pygame(render=True, audio=True):
+    # Solo los subsistemas que usa cada modo, no pygame.init() entero:
+    # jugar (render + audio), sin sonido (render), sin ventana o pruebas de
+    # rendimiento (ninguno). La ventana se abre al dibujar el primer frame.
+    global clock
+    if render:
+        pygame.display.init()
+        pygame.font.init()
+        clock = pygame.time.Clock()
+    if audio:
+        try:
+            pygame.mixer.init()
+        except pygame.error:
+            pass  # Sin dispositivo de audio: los sonidos quedan mudos
+
+def open_window():
+    global screen
+    if screen is None:
+        screen = pygame.display.set_mode((WIDTH, HEIGHT))
+        pygame.display.set_caption("Dig Dug con IA")
+    return screen
+
+def read_keyboard():
+    keys = pygame.key.get_pressed()
+    buttons = 0
+    if keys[pygame.K_LEFT]:
+        buttons |= INPUT_LEFT
+    if keys[pygame.K_RIGHT]:
+        buttons |= INPUT_RIGHT
+    if keys[pygame.K_UP]:
+        buttons |= INPUT_UP
+    if keys[pygame.K_DOWN]:
+        buttons |= INPUT_DOWN
+    if keys[pygame.K_SPACE]:
+        buttons |= INPUT_PUMP
+    return buttons
 
 # Carpetas para recursos
 game_dir = os.path.dirname(__file__)
@@ -40,12 +92,84 @@ assets_dir = os.path.join(game_dir, "assets")
 sound_dir = os.path.join(assets_dir, "sound")
 img_dir = os.path.join(assets_dir, "img")
 
+# Sonido mudo para cuando no hay mezclador (modo sin ventana o sin audio)
+class SilentSound:
+    def play(self, *args, **kwargs):
+        return None
+
 # Cargar sonidos y música
 def load_sound(filename):
+    if not pygame.mixer.get_init():
+        return SilentSound()
     return pygame.mixer.Sound(os.path.join(sound_dir, filename))
 
+# Banco de sonidos: cada fichero se decodifica una sola vez y todos comparten
+# el mismo Sound. preload() los decodifica en un hilo en segundo plano (durante
+# el menú); si se reproduce uno que aún no está listo, se carga en el acto.
+class SoundBank:
+    def __init__(self):
+        self.sounds = {}  # fichero -> Sound decodificado
+        self.handles = {}  # (fichero, límite) -> BankSound
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def get(self, filename, max_instances=None):
+        # Sonido compartido; con `max_instances` no se solapan más copias
+        if not pygame.mixer.get_init():
+            return SilentSound()
+        key = (filename, max_instances)
+        handle = self.handles.get(key)
+        if handle is None:
+            handle = self.handles[key] = BankSound(self, filename, max_instances)
+        return handle
+    
+    def load(self, filename):
+        sound = self.sounds.get(filename)
+        if sound is None:
+            with self.lock:
+                sound = self.sounds.get(filename)
+                if sound is None:
+                    sound = self.sounds[filename] = load_sound(filename)
+        return sound
+    
+    def preload(self, filenames):
+        if not pygame.mixer.get_init() or self.thread is not None:
+            return
+        
+        def decode():
+            for filename in filenames:
+                try:
+                    self.load(filename)
+                except (pygame.error, OSError):
+                    pass  # Se volverá a intentar (y se verá el error) al reproducirlo
+        
+        self.thread = threading.Thread(target=decode, name="sound-preload", daemon=True)
+        self.thread.start()
+
+class BankSound:
+    def __init__(self, bank, filename, max_instances=None):
+        self.bank = bank
+        self.filename = filename
+        self.max_instances = max_instances
+    
+    def play(self, *args, **kwargs):
+        sound = self.bank.load(self.filename)
+        if self.max_instances is not None:
+            # Sonidos repetitivos (excavar): no insistir si ya suenan bastantes
+            # copias o si todos los canales están ocupados
+            if sound.get_num_channels() >= self.max_instances or pygame.mixer.find_channel() is None:
+                return None
+        return sound.play(*args, **kwargs)
+
+sound_bank = SoundBank()
+
 def load_music(filename):
-    pygame.mixer.music.load(os.path.join(sound_dir, filename))
+    if pygame.mixer.get_init():
+        pygame.mixer.music.load(os.path.join(sound_dir, filename))
+
+def play_music(loops=-1):
+    if pygame.mixer.get_init():
+        pygame.mixer.music.play(loops)
 
 # Cargar imágenes
 def load_image(filename, scale=1):
@@ -56,6 +180,200 @@ def load_image(filename, scale=1):
         img = pygame.transform.scale(img, (new_width, new_height))
     return img
 
+# Atlas de sprites: superficies preparadas una sola vez (convert) y compartidas
+# por todas las instancias, una por tipo de enemigo y nivel de bombeo, más el
+# jugador y el fuego de Fygar. Si hay un <nombre>.png en img_dir se usa,
+# escalado a cada tamaño; si no, se dibujan las figuras de siempre.
+class SpriteAtlas:
+    FIRE_LENGTH = 3  # Casillas
+    
+    def __init__(self):
+        self.frames = {}
+        self.images = {}
+    
+    def prepare(self, surface):
+        # convert() necesita ventana; sin ella la superficie se deja tal cual
+        if pygame.display.get_surface() is None:
+            return surface
+        if surface.get_flags() & pygame.SRCALPHA:
+            return surface.convert_alpha()
+        return surface.convert()
+    
+    def image(self, name, size):
+        # Imagen del disco escalada, o None si no existe
+        if name not in self.images:
+            path = os.path.join(img_dir, name + ".png")
+            self.images[name] = load_image(name + ".png") if os.path.exists(path) else None
+        image = self.images[name]
+        return pygame.transform.smoothscale(image, (size, size)) if image else None
+    
+    def enemy(self, name, color, level, size):
+        key = (name, color, level)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.image(name, size)
+            if frame is None:
+                # Cuerpo del color del enemigo con dos ojos
+                frame = pygame.Surface((size, size))
+                frame.fill(color)
+                eye_radius = max(2, int(size / 10))
+                eye_offset = max(2, int(size / 5))
+                center = size // 2
+                pygame.draw.circle(frame, WHITE, (center - eye_offset, center - eye_offset), eye_radius)
+                pygame.draw.circle(frame, WHITE, (center + eye_offset, center - eye_offset), eye_radius)
+            frame = self.frames[key] = self.prepare(frame)
+        return frame
+    
+    def player(self, size):
+        frame = self.frames.get("player")
+        if frame is None:
+            frame = self.image("player", size)
+            if frame is None:
+                frame = pygame.Surface((size, size))
+                frame.fill(RED)
+            frame = self.frames["player"] = self.prepare(frame)
+        return frame
+    
+    def fire(self, direction):
+        # Llamarada en una dirección y su desplazamiento desde el centro de Fygar
+        key = ("fire", direction)
+        entry = self.frames.get(key)
+        if entry is None:
+            length = self.FIRE_LENGTH * TILE_SIZE
+            canvas = pygame.Surface((2 * length + TILE_SIZE, 2 * length + TILE_SIZE), pygame.SRCALPHA)
+            start = (length + TILE_SIZE // 2, length + TILE_SIZE // 2)
+            end = (start[0] + direction[0] * length, start[1] + direction[1] * length)
+            bounds = pygame.draw.line(canvas, (255, 0, 0), start, end, 4)
+            
+            # Llamas en el extremo
+            flame_rect = pygame.Rect(0, 0, TILE_SIZE // 2, TILE_SIZE // 2)
+            flame_rect.center = end
+            bounds.union_ip(pygame.draw.rect(canvas, (255, 165, 0), flame_rect))
+            frame = self.prepare(canvas.subsurface(bounds).copy())
+            entry = self.frames[key] = (frame, (bounds.x - start[0], bounds.y - start[1]))
+        return entry
+    
+    def preload(self, enemy_classes):
+        # Construir de antemano todos los fotogramas que puede necesitar el juego
+        self.player(Player.SIZE)
+        for cls in enemy_classes:
+            for level in range(cls.max_pump + 1):
+                self.enemy(cls.sprite_name, cls.color, level, cls.body_size(level))
+        for direction in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            self.fire(direction)
+
+sprite_atlas = SpriteAtlas()
+
+# Instrumentación por frame: tiempos por sección, contadores y asignaciones.
+# Desactivado no mide nada; start() devuelve None y stop() retorna enseguida.
+class Profiler:
+    def __init__(self, history=120, max_trace_events=50000):
+        self.enabled = False
+        self.overlay = False
+        self.frame = {}  # nombre -> [ms, llamadas] del frame en curso
+        self.history = deque(maxlen=history)  # frames anteriores
+        self.trace = deque(maxlen=max_trace_events)  # eventos para chrome://tracing
+        self.origin = time.perf_counter()
+        self.frame_blocks = 0
+        self.gc_collections = 0
+        self.font = None
+        self.first_frame_ms = None  # Desde el arranque hasta el primer frame en pantalla
+    
+    def enable(self, enabled=True):
+        if enabled and not self.enabled:
+            gc.callbacks.append(self.on_gc)
+        elif not enabled and self.enabled:
+            gc.callbacks.remove(self.on_gc)
+        self.enabled = enabled
+    
+    def on_gc(self, phase, info):
+        if phase == "start" and info["generation"] == 0:
+            self.gc_collections += 1
+    
+    def start(self):
+        return time.perf_counter() if self.enabled else None
+    
+    def stop(self, name, started):
+        if started is None:
+            return
+        now = time.perf_counter()
+        entry = self.frame.get(name)
+        if entry is None:
+            entry = self.frame[name] = [0.0, 0]
+        entry[0] += (now - started) * 1000
+        entry[1] += 1
+        self.trace.append((name, started, now))
+    
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        entry = self.frame.get(name)
+        if entry is None:
+            entry = self.frame[name] = [0.0, 0]
+        entry[1] += amount
+    
+    def begin_frame(self):
+        if not self.enabled:
+            return None
+        self.frame = {}
+        self.gc_collections = 0
+        self.frame_blocks = sys.getallocatedblocks()
+        return time.perf_counter()
+    
+    def end_frame(self, started):
+        if started is None:
+            return
+        self.stop("frame", started)
+        # Bloques de memoria netos creados durante el frame y colecciones de gc
+        self.count("alloc.blocks", sys.getallocatedblocks() - self.frame_blocks)
+        self.count("alloc.gc0", self.gc_collections)
+        self.history.append(self.frame)
+    
+    def averages(self):
+        # Media por frame de cada sección en el historial: nombre -> (ms, llamadas)
+        totals = {}
+        for frame in self.history:
+            for name, (ms, calls) in frame.items():
+                total = totals.setdefault(name, [0.0, 0])
+                total[0] += ms
+                total[1] += calls
+        frames = max(1, len(self.history))
+        return {name: (ms / frames, calls / frames) for name, (ms, calls) in sorted(totals.items())}
+    
+    def to_json(self):
+        return {
+            "frames": [{name: {"ms": ms, "calls": calls} for name, (ms, calls) in frame.items()}
+                       for frame in self.history],
+            "average": {name: {"ms": ms, "calls": calls} for name, (ms, calls) in self.averages().items()},
+            "first_frame_ms": self.first_frame_ms,
+        }
+    
+    def to_chrome_trace(self):
+        events = [{"name": name, "ph": "X", "pid": 0, "tid": 0,
+                   "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6}
+                  for name, start, end in self.trace]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+    
+    def export(self, json_path, trace_path):
+        with open(json_path, "w") as f:
+            json.dump(self.to_json(), f, indent=1)
+        with open(trace_path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+    
+    def draw(self, surface):
+        # Panel semitransparente con la media de los últimos frames
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+        lines = [f"{name:<16}{ms:7.2f} ms {calls:7.1f}" for name, (ms, calls) in self.averages().items()]
+        line_height = self.font.get_linesize()
+        panel = pygame.Surface((260, line_height * len(lines) + 8), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 180))
+        for i, line in enumerate(lines):
+            panel.blit(self.font.render(line, True, WHITE), (4, 4 + i * line_height))
+        return surface.blit(panel, (surface.get_width() - panel.get_width() - 4, 50))
+
+profiler = Profiler()
+
 # Estados del juego
 class GameState(Enum):
     MENU = 0
@@ -63,6 +381,68 @@ class GameState(Enum):
     GAME_OVER = 2
     WIN = 3
 
+# Caché de textos renderizados, por (fuente, texto, color). Renderizar con
+# una fuente es de lo más caro de un frame y los textos se repiten mucho; al
+# llenarse se descarta el usado hace más tiempo.
+class TextCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+    
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.entries.get(key)
+        if surface is not None:
+            self.entries.move_to_end(key)
+            return surface
+        surface = font.render(text, True, color)
+        self.entries[key] = surface
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return surface
+
+text_cache = TextCache()
+
+# Un valor del HUD: solo se vuelve a renderizar cuando cambia
+class HudWidget:
+    def __init__(self, font, template, pos, color=WHITE):
+        self.font = font
+        self.template = template
+        self.pos = pos
+        self.color = color
+        self.values = None
+        self.surface = None
+        self.rect = pygame.Rect(pos, (0, 0))
+    
+    def update(self, *values):
+        if values == self.values:
+            return False
+        self.values = values
+        self.surface = text_cache.render(self.font, self.template.format(*values), self.color)
+        self.rect = self.surface.get_rect(topleft=self.pos)
+        return True
+
+# HUD de la partida compuesto sobre una franja transparente que solo se
+# retoca cuando cambia algún valor; cada frame basta con copiar sus zonas
+class Hud:
+    def __init__(self, font):
+        self.score = HudWidget(font, "Puntuación: {}", (10, 10))
+        self.lives = HudWidget(font, "Vidas: {}", (10, 50))
+        self.enemies = HudWidget(font, "Enemigos: {}/{}", (WIDTH - 200, 10))
+        self.widgets = (self.score, self.lives, self.enemies)
+        self.strip = pygame.Surface((WIDTH, 50 + font.get_linesize()), pygame.SRCALPHA)
+    
+    def update(self, score, lives, defeated, max_enemies):
+        for widget, values in ((self.score, (score,)), (self.lives, (lives,)),
+                               (self.enemies, (defeated, max_enemies))):
+            old_rect = widget.rect
+            if widget.update(*values):
+                self.strip.fill((0, 0, 0, 0), old_rect)
+                self.strip.blit(widget.surface, widget.rect)
+    
+    def draw(self, surface):
+        return [surface.blit(self.strip, widget.rect, widget.rect) for widget in self.widgets]
+
 # Clase para el menú principal
 class Menu:
     def __init__(self):
@@ -82,21 +462,140 @@ class Menu:
         surface.blit(self.start_text, start_rect)
         surface.blit(self.quit_text, quit_rect)
 
+# Datos por celda que se calculan cada vez que se piden, sin guardarlos: en un
+# mapa grande la memoria no crece con las celdas consultadas (en uno pequeño
+# Grid usa listas completas, que se indexan más rápido).
+class CellTable:
+    def __init__(self, compute, size):
+        self.compute = compute
+        self.size = size
+    
+    def __len__(self):
+        return self.size
+    
+    def __getitem__(self, i):
+        return self.compute(i)
+
 # Clase para el grid del juego
 class Grid:
-    def __init__(self):
-        self.width = GRID_WIDTH
-        self.height = GRID_HEIGHT
+    # Tablas de traducción: valor de celda -> 0/1 para las máscaras
+    PASSABLE_TABLE = bytes([1, 1, 0] + [0] * 253)
+    TUNNEL_TABLE = bytes([0, 1] + [0] * 254)
+    # El terreno se pre-renderiza por trozos de CHUNK_SIZE x CHUNK_SIZE celdas;
+    # solo se guardan los últimos usados (los que se ven y algo de margen)
+    CHUNK_SIZE = 16
+    MAX_CHUNK_SURFACES = 16
+    # Hasta este número de celdas, coordenadas y vecinos se calculan de una vez
+    EAGER_TABLE_CELLS = 128 * 128
+    
+    def __init__(self, rng=None, width=GRID_WIDTH, height=GRID_HEIGHT):
+        # Generador aleatorio de la partida, compartido con los enemigos
+        self.rng = rng or random.Random()
+        self.width = width
+        self.height = height
+        size = self.width * self.height
+        
+        # Representación compacta: un byte por celda, indexado por y*width+x
+        self.cells = bytearray(size)
+        # Se mantiene la API grid[y][x] para leer: cada fila es una vista sobre
+        # `cells`. Es de solo lectura porque escribir en ella dejaría sin
+        # actualizar las máscaras, la versión y la caché; se cambia con dig/load.
+        view = memoryview(self.cells).toreadonly()
+        self.grid = [view[y * self.width:(y + 1) * self.width] for y in range(self.height)]
+        if size <= self.EAGER_TABLE_CELLS:
+            self.coords = [self.coord(i) for i in range(size)]
+        else:
+            self.coords = CellTable(self.coord, size)
+        
+        # Versión del terreno: aumenta cada vez que cambia una celda
+        self.version = 0
+        self.path_cache = PathCache(self)
+        # Qué enemigos hay en cada celda (colisiones, bombeo, no apilarse)
+        self.occupancy = OccupancyIndex(self)
+        # Clústeres para A* jerárquico (se construyen al usarlos)
+        self.clusters = ClusterGraph(self)
+        # Arrays de trabajo de A* libres para reutilizar (ver SearchBuffers)
+        self.search_buffers = []
+        # Trozos de terreno pre-renderizados, (cx, cy) -> superficie (al dibujar)
+        self.chunk_surfaces = OrderedDict()
+        self.surface_version = 0
         self.reset()
     
     def reset(self):
         # 0: Tierra (no excavada), 1: Túnel (excavado), 2: Roca
-        self.grid = [[0 for _ in range(self.width)] for _ in range(self.height)]
+        self.cells[:] = bytes(len(self.cells))
+        self.occupancy.clear()
+        
+        # Colocar algunas rocas aleatoriamente (15 en el mapa de 25x19, las
+        # mismas por celda en mapas más grandes)
+        for _ in range(max(15, 15 * len(self.cells) // (GRID_WIDTH * GRID_HEIGHT))):
+            x, y = self.rng.randint(1, self.width-2), self.rng.randint(1, self.height-2)
+            self.cells[y * self.width + x] = 2
+        
+        self.rebuild()
+    
+    def load(self, cells):
+        # Sustituir todo el terreno (mapas sintéticos, pruebas de rendimiento)
+        self.cells[:] = cells
+        self.rebuild()
+    
+    def rebuild(self):
+        # Máscaras para consultas en bloque. Las rocas solo cambian aquí, así que
+        # la máscara de paso y los vecinos se calculan una vez por mapa; la de
+        # túneles la mantiene dig().
+        passable = self.cells.translate(self.PASSABLE_TABLE)
+        self.tunnel = self.cells.translate(self.TUNNEL_TABLE)
+        if passable != getattr(self, "passable", None):
+            self.passable = passable
+            self.build_neighbors()
+            # Zonas conexas: solo las rocas las separan, así que excavar no las
+            # cambia. Se etiquetan al preguntar por ellas (0: sin etiquetar).
+            self.labels = array("i", [0]) * len(self.cells)
+            self.label_count = 0
         
-        # Colocar algunas rocas aleatoriamente
-        for _ in range(15):
-            x, y = random.randint(1, self.width-2), random.randint(1, self.height-2)
-            self.grid[y][x] = 2
+        # Un mapa nuevo invalida todos los caminos calculados antes
+        self.version += 1
+        self.reset_version = self.version
+        self.changes = []  # Celdas excavadas desde el último reset, en orden
+        self.path_cache.clear()
+    
+    def build_neighbors(self):
+        # Vecinos transitables de cada celda: arriba, derecha, abajo, izquierda.
+        # En mapas grandes se calculan cada vez que se piden, con la máscara de
+        # paso actual.
+        if len(self.cells) <= self.EAGER_TABLE_CELLS:
+            self.neighbors = [self.passable_neighbors(i) for i in range(len(self.cells))]
+            self.neighbor_cells = [self.passable_neighbor_cells(i) for i in range(len(self.cells))]
+        else:
+            self.neighbors = CellTable(self.passable_neighbors, len(self.cells))
+            self.neighbor_cells = CellTable(self.passable_neighbor_cells, len(self.cells))
+    
+    def passable_neighbors(self, i):
+        # En mapas grandes se llama en cada expansión de A*: comprobar la
+        # máscara directamente, sin generar los candidatos antes
+        w = self.width
+        x = i % w
+        passable = self.passable
+        result = []
+        if i >= w and passable[i - w]:
+            result.append(i - w)
+        if x < w - 1 and passable[i + 1]:
+            result.append(i + 1)
+        if i + w < len(passable) and passable[i + w]:
+            result.append(i + w)
+        if x > 0 and passable[i - 1]:
+            result.append(i - 1)
+        return tuple(result)
+    
+    def passable_neighbor_cells(self, i):
+        coords = self.coords
+        return tuple(coords[n] for n in self.neighbors[i])
+    
+    def coord(self, i):
+        return (i % self.width, i // self.width)
+    
+    def index(self, x, y):
+        return y * self.width + x
     
     def is_valid_position(self, x, y):
         return 0 <= x < self.width and 0 <= y < self.height
@@ -104,32 +603,363 @@ class Grid:
     def is_tunnel(self, x, y):
         if not self.is_valid_position(x, y):
             return False
-        return self.grid[y][x] == 1
+        return self.tunnel[y * self.width + x] == 1
     
     def is_rock(self, x, y):
         if not self.is_valid_position(x, y):
             return False
-        return self.grid[y][x] == 2
+        return self.cells[y * self.width + x] == 2
     
-    def dig(self, x, y):
-        if self.is_valid_position(x, y) and not self.is_rock(x, y):
-            self.grid[y][x] = 1
+    def label_of(self, i):
+        # Etiqueta de la zona conexa (sin rocas) de la celda `i`; 0 si es roca
+        if not self.passable[i]:
+            return 0
+        label = self.labels[i]
+        if not label:
+            self.label_count += 1
+            label = self.label_count
+            self.flood(i, label)
+        return label
+    
+    def flood(self, i, label):
+        # Relleno por tramos de fila: cada tramo entre rocas se etiqueta de una
+        # vez y se buscan tramos nuevos en las filas de arriba y de abajo
+        w = self.width
+        passable, labels = self.passable, self.labels
+        fill = array("i", [label])
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            if labels[i]:
+                continue
+            row = i - i % w
+            left = passable.rfind(0, row, i) + 1 or row
+            right = passable.find(0, i, row + w)
+            if right < 0:
+                right = row + w
+            labels[left:right] = fill * (right - left)
+            for j in (left - w, left + w):
+                if not 0 <= j < len(passable):
+                    continue
+                end = j + right - left
+                while j < end:
+                    j = passable.find(1, j, end)
+                    if j < 0:
+                        break
+                    if not labels[j]:
+                        stack.append(j)
+                    j = passable.find(0, j, end)
+                    if j < 0:
+                        break
+    
+    def is_reachable(self, start, goal):
+        # ¿Puede haber camino? Coste O(1) una vez etiquetadas las zonas. Desde
+        # una roca se puede salir a cualquier vecino; a una roca no se llega.
+        s, g = self.index(*start), self.index(*goal)
+        if s == g:
             return True
+        label = self.label_of(g)
+        if not label:
+            return False
+        if self.passable[s]:
+            return self.label_of(s) == label
+        return any(self.label_of(n) == label for n in self.neighbors[s])
+    
+    def is_line_clear(self, start, end):
+        # True si no hay rocas entre start (excluida) y end (incluida), en
+        # horizontal o vertical; se resuelve con un corte de la máscara de paso
+        (x0, y0), (x1, y1) = start, end
+        i0, i1 = y0 * self.width + x0, y1 * self.width + x1
+        stride = 1 if y0 == y1 else self.width
+        if i1 > i0:
+            segment = self.passable[i0 + stride:i1 + 1:stride]
+        else:
+            segment = self.passable[i1:i0:stride]
+        return 0 not in segment
+    
+    def dig(self, x, y):
+        if self.is_valid_position(x, y):
+            i = y * self.width + x
+            if self.cells[i] == 0:
+                self.cells[i] = 1
+                self.tunnel[i] = 1
+                self.changes.append((x, y))
+                self.version += 1
+                return True
+            return self.cells[i] == 1
         return False
     
-    def draw(self, surface):
-        for y in range(self.height):
-            for x in range(self.width):
-                rect = pygame.Rect(x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE)
-                if self.grid[y][x] == 0:  # Tierra
-                    pygame.draw.rect(surface, BROWN, rect)
-                elif self.grid[y][x] == 1:  # Túnel
-                    pygame.draw.rect(surface, LIGHT_BROWN, rect)
-                elif self.grid[y][x] == 2:  # Roca
-                    pygame.draw.rect(surface, (100, 100, 100), rect)
-                
-                # Dibujar líneas de la cuadrícula
-                pygame.draw.rect(surface, (100, 50, 0), rect, 1)
+    def changes_since(self, version):
+        # Celdas excavadas desde `version`, o None si hubo un reset entre medias
+        if version < self.reset_version:
+            return None
+        return self.changes[version - self.reset_version:]
+    
+    def is_path_current(self, path, version):
+        # Excavar solo abarata celdas: un camino sigue siendo óptimo si todas las
+        # celdas excavadas desde que se calculó forman parte de él. Como excavar
+        # nunca bloquea nada, "sin camino" sigue siendo cierto hasta el reset.
+        changes = self.changes_since(version)
+        if changes is None:
+            return False
+        if not changes or not path:
+            return True
+        cells = set(path)
+        return all(cell in cells for cell in changes)
+    
+    # Colores por tipo de celda: tierra, túnel, roca
+    TILE_COLORS = (BROWN, LIGHT_BROWN, (100, 100, 100))
+    
+    def draw_tile(self, chunk, x, y):
+        # Dibujar la celda en la superficie de su trozo; devuelve su zona en el mundo
+        rect = pygame.Rect(x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+        chunk_px = self.CHUNK_SIZE * TILE_SIZE
+        local = rect.move(-(rect.x // chunk_px) * chunk_px, -(rect.y // chunk_px) * chunk_px)
+        pygame.draw.rect(chunk, self.TILE_COLORS[self.cells[y * self.width + x]], local)
+        
+        # Dibujar líneas de la cuadrícula
+        pygame.draw.rect(chunk, (100, 50, 0), local, 1)
+        return rect
+    
+    def render_chunk(self, cx, cy):
+        # Pre-renderizar un trozo de terreno en una superficie fuera de pantalla
+        size = self.CHUNK_SIZE
+        x0, y0 = cx * size, cy * size
+        x1, y1 = min(x0 + size, self.width), min(y0 + size, self.height)
+        chunk = pygame.Surface(((x1 - x0) * TILE_SIZE, (y1 - y0) * TILE_SIZE))
+        if pygame.display.get_surface() is not None:
+            chunk = chunk.convert()
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                self.draw_tile(chunk, x, y)
+        return chunk
+    
+    def chunk_surface(self, cx, cy):
+        surfaces = self.chunk_surfaces
+        key = (cx, cy)
+        chunk = surfaces.get(key)
+        if chunk is None:
+            chunk = surfaces[key] = self.render_chunk(cx, cy)
+            if len(surfaces) > self.MAX_CHUNK_SURFACES:
+                surfaces.popitem(last=False)
+        else:
+            surfaces.move_to_end(key)
+        return chunk
+    
+    def pixel_rect(self):
+        return pygame.Rect(0, 0, self.width * TILE_SIZE, self.height * TILE_SIZE)
+    
+    def refresh_surface(self):
+        # Re-dibujar en los trozos guardados las celdas excavadas desde el
+        # último refresco (los demás se renderizan ya al día cuando se vean).
+        # Devuelve las zonas del mundo que han cambiado.
+        changes = self.changes_since(self.surface_version)
+        self.surface_version = self.version
+        if changes is None:
+            self.chunk_surfaces.clear()
+            return [self.pixel_rect()]
+        size = self.CHUNK_SIZE
+        rects = []
+        for x, y in changes:
+            chunk = self.chunk_surfaces.get((x // size, y // size))
+            if chunk is not None:
+                rects.append(self.draw_tile(chunk, x, y))
+            else:
+                rects.append(pygame.Rect(x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+        return rects
+    
+    def draw(self, surface, view=None, area=None):
+        # Dibujar el terreno que se ve en `view` (zona del mundo en píxeles; por
+        # defecto, la del tamaño de `surface` desde el origen), o solo la parte
+        # `area` de la pantalla. Solo se tocan los trozos visibles. Llamar antes
+        # a refresh_surface() para que las excavaciones estén al día.
+        if view is None:
+            view = surface.get_rect()
+        world = view if area is None else area.move(view.topleft)
+        world = world.clip(self.pixel_rect())
+        if not world:
+            return
+        chunk_px = self.CHUNK_SIZE * TILE_SIZE
+        for cy in range(world.top // chunk_px, (world.bottom - 1) // chunk_px + 1):
+            for cx in range(world.left // chunk_px, (world.right - 1) // chunk_px + 1):
+                chunk = self.chunk_surface(cx, cy)
+                origin = (cx * chunk_px, cy * chunk_px)
+                part = world.clip(chunk.get_rect(topleft=origin))
+                surface.blit(chunk, (part.x - view.x, part.y - view.y),
+                             part.move(-origin[0], -origin[1]))
+
+# Zona del mapa que se ve en la ventana, en píxeles del mundo. Sigue a un
+# sprite con margen: solo se desplaza cuando este se acerca al borde de la
+# vista, así que la mayoría de frames no obligan a redibujar todo.
+class Camera:
+    def __init__(self, width, height, world_rect, margin=4 * TILE_SIZE):
+        self.rect = pygame.Rect(0, 0, width, height)
+        self.world = world_rect
+        self.margin = margin
+        self.rect.clamp_ip(self.world)  # Mapa más pequeño que la vista: centrado
+    
+    @property
+    def offset(self):
+        # Desplazamiento de coordenadas del mundo a coordenadas de pantalla
+        return (-self.rect.x, -self.rect.y)
+    
+    def center_on(self, target):
+        self.rect.center = target.center
+        self.rect.clamp_ip(self.world)
+    
+    def follow(self, target):
+        # Devuelve True si la vista se ha desplazado
+        inner = self.rect.inflate(-2 * self.margin, -2 * self.margin)
+        dx = min(0, target.left - inner.left) + max(0, target.right - inner.right)
+        dy = min(0, target.top - inner.top) + max(0, target.bottom - inner.bottom)
+        if not dx and not dy:
+            return False
+        old = self.rect.topleft
+        self.rect.move_ip(dx, dy)
+        self.rect.clamp_ip(self.world)
+        return self.rect.topleft != old
+
+# Ejecutar hasta el final una búsqueda troceada (generador) y devolver su resultado
+def run_to_completion(steps):
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+# Caché de caminos compartida por todos los buscadores de un mismo grid
+class PathCache:
+    MISS = object()
+    
+    def __init__(self, grid, max_entries=512):
+        self.grid = grid
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def clear(self):
+        self.entries.clear()
+    
+    def get(self, start, goal):
+        entry = self.entries.get((start, goal))
+        if entry is None:
+            self.misses += 1
+            return self.MISS
+        
+        path, version = entry
+        if version != self.grid.version:
+            # Invalidar solo si alguna excavación puede dar un camino mejor
+            if not self.grid.is_path_current(path, version):
+                del self.entries[(start, goal)]
+                self.misses += 1
+                return self.MISS
+            self.entries[(start, goal)] = (path, self.grid.version)
+        
+        self.hits += 1
+        return path
+    
+    def put(self, start, goal, path, version=None):
+        if len(self.entries) >= self.max_entries:
+            # Descartar la entrada más antigua
+            del self.entries[next(iter(self.entries))]
+        self.entries[(start, goal)] = (path, self.grid.version if version is None else version)
+
+# Índice de ocupación: celda (índice plano) -> entidades en ella. Se mantiene
+# al mover cada entidad, así las consultas por celda o vecindad no recorren la
+# lista de enemigos.
+class OccupancyIndex:
+    def __init__(self, grid):
+        self.grid = grid
+        self.cells = {}
+    
+    def clear(self):
+        self.cells.clear()
+    
+    def add(self, entity):
+        index = self.grid.index(entity.grid_x, entity.grid_y)
+        occupants = self.cells.get(index)
+        if occupants is None:
+            self.cells[index] = [entity]
+        else:
+            occupants.append(entity)
+    
+    def remove(self, entity):
+        index = self.grid.index(entity.grid_x, entity.grid_y)
+        occupants = self.cells.get(index)
+        if occupants is not None and entity in occupants:
+            occupants.remove(entity)
+            if not occupants:
+                del self.cells[index]
+    
+    def move(self, entity, x, y):
+        # Llamar antes de cambiar grid_x/grid_y de la entidad
+        self.remove(entity)
+        index = self.grid.index(x, y)
+        occupants = self.cells.get(index)
+        if occupants is None:
+            self.cells[index] = [entity]
+        else:
+            occupants.append(entity)
+    
+    def at(self, x, y):
+        return self.cells.get(self.grid.index(x, y), ())
+    
+    def is_occupied(self, x, y, ignore=None):
+        occupants = self.cells.get(self.grid.index(x, y))
+        if not occupants:
+            return False
+        return ignore is None or any(entity is not ignore for entity in occupants)
+    
+    def first_adjacent(self, x, y):
+        # Primera entidad en la celda o en las 8 de alrededor
+        cells = self.cells
+        if not cells:
+            return None
+        width = self.grid.width
+        for ny in range(max(0, y - 1), min(self.grid.height, y + 2)):
+            for nx in range(max(0, x - 1), min(width, x + 2)):
+                occupants = cells.get(ny * width + nx)
+                if occupants:
+                    return occupants[0]
+        return None
+
+# Arrays de trabajo de A* sobre índices de celda, reutilizables entre búsquedas:
+# en vez de vaciarlos, cada búsqueda usa una generación nueva y el dato de una
+# celda solo vale si su sello coincide con ella. El grid guarda los libres; una
+# búsqueda troceada retiene los suyos hasta terminar. Con `sparse` (mapas
+# grandes) son diccionarios con solo las celdas de la búsqueda en curso, así
+# que las búsquedas en espera no ocupan memoria por todo el mapa (los sellos
+# son defaultdict(int): 0 si no se guardó, sin llamar a código Python).
+class SearchBuffers:
+    def __init__(self, size, sparse=False):
+        self.generation = 0
+        self.sparse = sparse
+        if sparse:
+            self.seen, self.closed = defaultdict(int), defaultdict(int)
+            self.g, self.parent, self.depth = {}, {}, {}
+            return
+        self.seen = array("I", [0]) * size  # Generación en que se alcanzó la celda
+        self.closed = array("I", [0]) * size  # Generación en que se expandió
+        self.g = array("i", [0]) * size
+        self.parent = array("i", [0]) * size
+        self.depth = array("i", [0]) * size  # Celdas desde el inicio (max_length)
+    
+    def next_generation(self):
+        if self.generation == 0xFFFFFFFF and not self.sparse:
+            # Tras dar la vuelta el contador, ningún sello antiguo debe coincidir
+            self.seen = array("I", [0]) * len(self.seen)
+            self.closed = array("I", [0]) * len(self.closed)
+            self.generation = 0
+        self.generation += 1
+        return self.generation
+    
+    def release(self):
+        # Al terminar una búsqueda: los diccionarios se vacían para no
+        # retener memoria mientras esperan en la lista de libres
+        if self.sparse:
+            for table in (self.seen, self.closed, self.g, self.parent, self.depth):
+                table.clear()
 
 # Implementación de A* para pathfinding
 class AStar:
@@ -141,64 +971,931 @@ class AStar:
         return abs(a[0] - b[0]) + abs(a[1] - b[1])
     
     def get_neighbors(self, node):
+        # Vecinos precalculados por el grid: túneles y tierra, nunca rocas
+        # (la tierra cuesta más, ver search_steps)
         x, y = node
-        neighbors = []
-        
-        # Direcciones: arriba, derecha, abajo, izquierda
-        directions = [(0, -1), (1, 0), (0, 1), (-1, 0)]
-        
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if self.grid.is_valid_position(nx, ny) and not self.grid.is_rock(nx, ny):
-                if self.grid.is_tunnel(nx, ny):
-                    neighbors.append((nx, ny))
-                # Si no es túnel, pero es tierra, considerarlo con mayor costo
-                # (para que el enemigo prefiera seguir túneles existentes)
-                elif self.grid.grid[ny][nx] == 0:
-                    neighbors.append((nx, ny))
-        
-        return neighbors
-    
-    def find_path(self, start, goal):
-        # Inicializar estructuras para A*
-        open_set = []
-        heapq.heappush(open_set, (0, start))
-        came_from = {}
-        g_score = {start: 0}
-        f_score = {start: self.heuristic(start, goal)}
-        open_set_hash = {start}
+        return self.grid.neighbor_cells[y * self.grid.width + x]
+    
+    def find_path(self, start, goal, max_expansions=None, max_length=None, partial=False):
+        started = profiler.start()
+        path = run_to_completion(self.find_path_steps(start, goal, None, max_expansions, max_length, partial))
+        profiler.stop("astar.find_path", started)
+        return path
+    
+    def find_path_steps(self, start, goal, chunk=None, max_expansions=None, max_length=None, partial=False):
+        # Como find_path, pero se puede repartir entre frames: cede el control
+        # cada `chunk` nodos expandidos (ver AIScheduler)
+        cache = self.grid.path_cache
+        path = cache.get(start, goal)
+        if path is not PathCache.MISS:
+            # Un camino guardado vale si cumple el límite de longitud; "sin
+            # camino" vale salvo que se pida el mejor camino parcial
+            if path is None and not partial or path is not None and (max_length is None or len(path) <= max_length):
+                return path
+        # Reutilizar el camino si el terreno no cambió de forma relevante.
+        # Se guarda con la versión del inicio: si se excavó mientras
+        # tanto, la caché lo comprobará al reutilizarlo. Lo que recortó algún
+        # límite no se guarda: otra búsqueda sin límites daría otro resultado.
+        version = self.grid.version
+        path = yield from self.search_steps(start, goal, chunk, max_expansions, max_length, partial)
+        if not self.truncated and (path is None or path[-1] == goal):
+            cache.put(start, goal, path, version)
+        profiler.count("astar.nodes", self.nodes_expanded)
+        return path
+    
+    def search(self, start, goal, max_expansions=None, max_length=None, partial=False):
+        return run_to_completion(self.search_steps(start, goal, None, max_expansions, max_length, partial))
+    
+    def search_steps(self, start, goal, chunk=None, max_expansions=None, max_length=None, partial=False):
+        # Límites opcionales: como mucho `max_expansions` nodos expandidos y
+        # caminos de como mucho `max_length` celdas (se descartan los nodos que
+        # ya no pueden llegar a tiempo). Si no se llega al objetivo, con
+        # `partial` se devuelve el camino a la celda más cercana a él que se
+        # haya expandido (None si es el propio inicio). `truncated` indica si
+        # algún límite recortó la búsqueda.
+        self.nodes_expanded = 0
+        self.truncated = False
+        if not partial:
+            # Objetivo en otra zona (o en una roca): ni se busca
+            if not self.grid.is_reachable(start, goal):
+                return None
+            if max_length is not None and self.heuristic(start, goal) >= max_length:
+                self.truncated = True
+                return None
+        
+        grid = self.grid
+        free = grid.search_buffers
+        buffers = free.pop() if free else SearchBuffers(len(grid.cells), len(grid.cells) > grid.EAGER_TABLE_CELLS)
+        try:
+            return (yield from self.run_search(buffers, start, goal, chunk, max_expansions, max_length, partial))
+        finally:
+            buffers.release()
+            free.append(buffers)
+    
+    def run_search(self, buffers, start, goal, chunk, max_expansions, max_length, partial):
+        # A* sobre índices de celda. Cada entrada del montículo es un solo
+        # entero (f, h, celda) empaquetado: a igual f sale antes la celda más
+        # cercana al objetivo, y después la de menor índice. Las entradas
+        # obsoletas (la celda mejoró o ya se expandió) se descartan al sacarlas.
+        grid = self.grid
+        width, size = grid.width, len(grid.cells)
+        span = width + grid.height  # Mayor que cualquier distancia Manhattan
+        neighbors, coords, tunnel = grid.neighbors, grid.coords, grid.tunnel
+        generation = buffers.next_generation()
+        seen, closed = buffers.seen, buffers.closed
+        g_score, parent, steps = buffers.g, buffers.parent, buffers.depth
+        heappush, heappop = heapq.heappush, heapq.heappop
+        gx, gy = goal
+        s, t = start[1] * width + start[0], gy * width + gx
+        
+        h = abs(start[0] - gx) + abs(start[1] - gy)
+        seen[s] = generation
+        g_score[s] = 0
+        parent[s] = -1
+        steps[s] = 0
+        open_set = [(h * span + h) * size + s]
+        best, best_h = s, h
         
         while open_set:
-            _, current = heapq.heappop(open_set)
-            open_set_hash.remove(current)
+            current = heappop(open_set) % size
+            if closed[current] == generation:
+                continue
+            if max_expansions is not None and self.nodes_expanded >= max_expansions:
+                self.truncated = True
+                break
+            closed[current] = generation
+            self.nodes_expanded += 1
+            if chunk and self.nodes_expanded % chunk == 0:
+                yield chunk
             
-            if current == goal:
-                # Reconstruir el camino
-                path = []
-                while current in came_from:
-                    path.append(current)
-                    current = came_from[current]
-                path.append(start)
-                path.reverse()
-                return path
+            if current == t:
+                return self.trace_back(buffers, s, current)
+            if partial:
+                x, y = coords[current]
+                h = abs(x - gx) + abs(y - gy)
+                if h < best_h:
+                    best, best_h = current, h
             
-            for neighbor in self.get_neighbors(current):
-                # Costo adicional si es necesario excavar
-                dig_cost = 5 if not self.grid.is_tunnel(*neighbor) else 0
-                tentative_g_score = g_score[current] + 1 + dig_cost
+            g = g_score[current]
+            depth = steps[current] + 1
+            for neighbor in neighbors[current]:
+                if closed[neighbor] == generation:
+                    continue  # Heurística consistente: ya no puede mejorar
+                h = abs(neighbor % width - gx) + abs(neighbor // width - gy)
+                if max_length is not None and depth + h >= max_length:
+                    self.truncated = True
+                    continue
                 
-                if neighbor not in g_score or tentative_g_score < g_score[neighbor]:
-                    came_from[neighbor] = current
+                # Costo adicional si es necesario excavar
+                tentative_g_score = g + (1 if tunnel[neighbor] else 6)
+                if seen[neighbor] != generation or tentative_g_score < g_score[neighbor]:
+                    seen[neighbor] = generation
                     g_score[neighbor] = tentative_g_score
-                    f_score[neighbor] = tentative_g_score + self.heuristic(neighbor, goal)
-                    if neighbor not in open_set_hash:
-                        heapq.heappush(open_set, (f_score[neighbor], neighbor))
-                        open_set_hash.add(neighbor)
+                    parent[neighbor] = current
+                    steps[neighbor] = depth
+                    heappush(open_set, ((tentative_g_score + h) * span + h) * size + neighbor)
         
         # No se encontró camino
+        if partial and best != s:
+            return self.trace_back(buffers, s, best)
         return None
+    
+    def trace_back(self, buffers, start, current):
+        # Reconstruir el camino siguiendo los padres hasta el inicio
+        parent, coords = buffers.parent, self.grid.coords
+        path = []
+        while current != start:
+            path.append(coords[current])
+            current = parent[current]
+        path.append(coords[start])
+        path.reverse()
+        return tuple(path)
+
+# Distancias de un FlowField acotado: solo se guardan las celdas alcanzadas
+class SparseDistances(dict):
+    def __missing__(self, i):
+        return math.inf
+
+# Grafo abstracto para A* jerárquico (HPA*). El mapa se divide en clústeres de
+# SIZE x SIZE celdas; las entradas son parejas de celdas transitables a ambos
+# lados de la frontera entre dos clústeres (los extremos de cada tramo abierto
+# y los túneles que la cruzan). Dentro de cada clúster se precalcula el coste
+# entre sus entradas y el camino a nivel de celda, así que refinar un camino
+# abstracto no necesita buscar. Los clústeres se construyen al usarlos y una
+# excavación solo invalida el suyo (y el vecino si la celda está en la frontera).
+class ClusterGraph:
+    SIZE = 16
+    
+    def __init__(self, grid):
+        self.grid = grid
+        self.version = None
+        self.clusters = {}  # (cx, cy) -> (aristas, aristas entre clústeres, enlaces)
+        self.borders = {}  # ((cx, cy), (cx', cy')) -> [(celda de uno, celda del otro)]
+        self.expanded = 0  # Celdas expandidas construyendo clústeres y tramos locales
+        self.rebuilds = 0
+    
+    def refresh(self):
+        # Descartar lo que hayan cambiado las excavaciones desde la última consulta
+        grid = self.grid
+        if self.version == grid.version:
+            return
+        changes = grid.changes_since(self.version) if self.version is not None else None
+        if changes is None:
+            self.clusters.clear()
+            self.borders.clear()
+        else:
+            size = self.SIZE
+            for x, y in changes:
+                key = (x // size, y // size)
+                self.clusters.pop(key, None)
+                # Una celda de frontera puede crear o quitar una entrada
+                for other in ((key[0] - 1, key[1]) if x % size == 0 else None,
+                              (key[0] + 1, key[1]) if x % size == size - 1 else None,
+                              (key[0], key[1] - 1) if y % size == 0 else None,
+                              (key[0], key[1] + 1) if y % size == size - 1 else None):
+                    if other is not None:
+                        self.clusters.pop(other, None)
+                        self.borders.pop(self.border_key(key, other), None)
+        self.version = grid.version
+    
+    def border_key(self, a, b):
+        return (a, b) if (a[1], a[0]) < (b[1], b[0]) else (b, a)
+    
+    def key_of(self, i):
+        width = self.grid.width
+        return (i % width // self.SIZE, i // width // self.SIZE)
+    
+    def bounds(self, key):
+        size = self.SIZE
+        x0, y0 = key[0] * size, key[1] * size
+        return x0, y0, min(x0 + size, self.grid.width), min(y0 + size, self.grid.height)
+    
+    def border(self, a, b):
+        # Entradas entre dos clústeres vecinos: (celda en a, celda en b)
+        key = self.border_key(a, b)
+        entrances = self.borders.get(key)
+        if entrances is not None:
+            return entrances if key == (a, b) else [(q, p) for p, q in entrances]
+        first, second = key
+        grid = self.grid
+        width, passable, tunnel = grid.width, grid.passable, grid.tunnel
+        x0, y0, x1, y1 = self.bounds(first)
+        if first[1] == second[1]:  # Frontera vertical: columna x1 - 1 | x1
+            pairs = [(y * width + x1 - 1, y * width + x1) for y in range(y0, y1)]
+        else:  # Frontera horizontal: fila y1 - 1 | y1
+            pairs = [((y1 - 1) * width + x, y1 * width + x) for x in range(x0, x1)]
+        
+        entrances = []
+        run = []
+        for pair in pairs + [None]:
+            if pair is not None and passable[pair[0]] and passable[pair[1]]:
+                run.append(pair)
+                continue
+            if run:
+                # Extremos de los tramos largos (o el centro de los cortos) y
+                # el centro de cada grupo de túneles que cruzan la frontera
+                chosen = [run[0], run[-1]] if len(run) >= 6 else [run[len(run) // 2]]
+                crossing = []
+                for p in run + [None]:
+                    if p is not None and tunnel[p[0]] and tunnel[p[1]]:
+                        crossing.append(p)
+                    elif crossing:
+                        chosen.append(crossing[len(crossing) // 2])
+                        crossing = []
+                for p in chosen:
+                    if p not in entrances:
+                        entrances.append(p)
+                run = []
+        self.borders[key] = entrances
+        return entrances if key == (a, b) else [(q, p) for p, q in entrances]
+    
+    def cluster_steps(self, key):
+        # Generador: construir un clúster son varias búsquedas locales y se cede
+        # el control después de cada una (ver HPAStar.search_steps). Si entre
+        # medias se excavó dentro del clúster o junto a él, el resultado sirve a
+        # quien lo pidió pero no se guarda.
+        cluster = self.clusters.get(key)
+        if cluster is None:
+            version = self.grid.version
+            cluster = yield from self.build_steps(key)
+            changes = self.grid.changes_since(version)
+            x0, y0, x1, y1 = self.bounds(key)
+            if changes is not None and not any(x0 - 1 <= x <= x1 and y0 - 1 <= y <= y1
+                                               for x, y in changes):
+                self.clusters[key] = cluster
+        return cluster
+    
+    def build_steps(self, key):
+        self.rebuilds += 1
+        cx, cy = key
+        columns = (self.grid.width + self.SIZE - 1) // self.SIZE
+        rows = (self.grid.height + self.SIZE - 1) // self.SIZE
+        cross = {}
+        for other in ((cx, cy - 1), (cx + 1, cy), (cx, cy + 1), (cx - 1, cy)):
+            if 0 <= other[0] < columns and 0 <= other[1] < rows:
+                for inside, outside in self.border(key, other):
+                    cross.setdefault(inside, []).append(outside)
+        
+        # Coste y enlaces desde cada entrada hasta las demás del clúster
+        edges, links = {}, {}
+        for node in cross:
+            dist, links[node] = self.local_search(key, node)
+            edges[node] = tuple((other, dist[other]) for other in cross
+                                if other != node and other in dist)
+            yield
+        return edges, cross, links
+    
+    def local_search(self, key, source, backward=False):
+        # Dijkstra dentro del clúster desde `source` (o hacia él, con
+        # `backward`). Devuelve las distancias y, por celda, un código con la
+        # dirección de la celda anterior (o de la siguiente hacia `source`).
+        grid = self.grid
+        width, tunnel, neighbors = grid.width, grid.tunnel, grid.neighbors
+        size = self.SIZE
+        x0, y0, x1, y1 = self.bounds(key)
+        codes = {-width: 1, 1: 2, width: 3, -1: 4}
+        dist = {source: 0}
+        links = bytearray(size * size)
+        open_set = [(0, source)]
+        while open_set:
+            d, u = heapq.heappop(open_set)
+            if d > dist[u]:
+                continue
+            self.expanded += 1
+            # Entrar en u desde un vecino (hacia atrás) o entrar en el vecino
+            leave = d + (1 if tunnel[u] else 6)
+            for n in neighbors[u]:
+                x, y = n % width, n // width
+                if not (x0 <= x < x1 and y0 <= y < y1):
+                    continue
+                nd = leave if backward else d + (1 if tunnel[n] else 6)
+                if nd < dist.get(n, math.inf):
+                    dist[n] = nd
+                    links[(y - y0) * size + x - x0] = codes[u - n]
+                    heapq.heappush(open_set, (nd, n))
+        return dist, links
+    
+    def trace(self, key, links, cell):
+        # Seguir los enlaces de local_search() desde `cell` hasta el origen
+        width = self.grid.width
+        size = self.SIZE
+        x0, y0 = key[0] * size, key[1] * size
+        steps = (0, -width, 1, width, -1)
+        cells = [cell]
+        code = links[(cell // width - y0) * size + cell % width - x0]
+        while code:
+            cell += steps[code]
+            cells.append(cell)
+            code = links[(cell // width - y0) * size + cell % width - x0]
+        return cells
+
+# A* jerárquico sobre el ClusterGraph del grid: misma interfaz que AStar. Solo
+# se busca celda a celda en los clústeres del inicio y del objetivo; el resto
+# del camino sale de los tramos precalculados. Los caminos pueden ser algo más
+# caros que los de A*; las búsquedas cortas se hacen con A* directamente.
+class HPAStar(AStar):
+    def __init__(self, grid):
+        super().__init__(grid)
+        self.nodes_expanded = 0
+    
+    def search_steps(self, start, goal, chunk=None, max_expansions=None, max_length=None, partial=False):
+        # Las búsquedas acotadas son locales por naturaleza: A* directamente
+        grid = self.grid
+        graph = grid.clusters
+        graph.refresh()
+        s, t = grid.index(*start), grid.index(*goal)
+        start_key, goal_key = graph.key_of(s), graph.key_of(t)
+        if (start_key == goal_key or self.heuristic(start, goal) <= graph.SIZE or
+                max_expansions is not None or max_length is not None or partial):
+            return (yield from super().search_steps(start, goal, chunk, max_expansions, max_length, partial))
+        self.nodes_expanded = 0
+        self.truncated = False
+        if not grid.is_reachable(start, goal):
+            return None
+        
+        # El trabajo cuenta para `chunk` tanto si es del A* abstracto como si es
+        # de construir clústeres o de las búsquedas locales
+        work = yielded = graph.expanded
+        expanded = total = 0
+        def pause():
+            nonlocal expanded, yielded
+            if chunk and expanded + graph.expanded - yielded >= chunk:
+                yield expanded + graph.expanded - yielded
+                expanded, yielded = 0, graph.expanded
+        
+        # Clústeres que usa esta búsqueda. Entre pausas otras búsquedas pueden
+        # reconstruirlos con otras entradas, así que se refina con los mismos.
+        used = {}
+        def cluster(key):
+            data = used.get(key)
+            if data is None:
+                build = graph.cluster_steps(key)
+                while True:
+                    try:
+                        next(build)
+                    except StopIteration as done:
+                        data = used[key] = done.value
+                        break
+                    yield from pause()
+            return data
+        
+        # Tramos locales: del inicio a las entradas de su clúster y de las
+        # entradas del clúster del objetivo hasta él
+        start_dist, start_links = graph.local_search(start_key, s)
+        yield from pause()
+        goal_dist, goal_links = graph.local_search(goal_key, t, backward=True)
+        yield from pause()
+        start_edges = tuple((n, start_dist[n]) for n in (yield from cluster(start_key))[1]
+                            if n in start_dist and n != s)
+        
+        # A* sobre las entradas (la distancia Manhattan sigue siendo admisible)
+        width, tunnel = grid.width, grid.tunnel
+        gx, gy = goal
+        g_score = {s: 0}
+        came_from = {}
+        open_set = [(self.heuristic(start, goal), 0, s)]
+        while open_set:
+            _, d, u = heapq.heappop(open_set)
+            if d > g_score[u]:
+                continue  # Entrada obsoleta
+            expanded += 1
+            total += 1
+            yield from pause()
+            if u == t:
+                break
+            
+            key = graph.key_of(u)
+            edges, cross, _ = yield from cluster(key)
+            successors = list(start_edges if u == s else edges.get(u, ()))
+            for n in cross.get(u, ()):
+                successors.append((n, 1 if tunnel[n] else 6))
+            if key == goal_key and u in goal_dist:
+                successors.append((t, goal_dist[u]))
+            for n, cost in successors:
+                nd = d + cost
+                if nd < g_score.get(n, math.inf):
+                    g_score[n] = nd
+                    came_from[n] = u
+                    h = abs(n % width - gx) + abs(n // width - gy)
+                    heapq.heappush(open_set, (nd + h, nd, n))
+        self.nodes_expanded = total + graph.expanded - work
+        if t not in came_from:
+            return None
+        
+        # Refinar: unir los tramos de celda de cada arista abstracta
+        nodes = [t]
+        while nodes[-1] != s:
+            nodes.append(came_from[nodes[-1]])
+        nodes.reverse()
+        cells = [s]
+        for u, v in zip(nodes, nodes[1:]):
+            if graph.key_of(u) != graph.key_of(v):
+                leg = [u, v]  # Cruce de frontera
+            elif u == s:
+                leg = graph.trace(start_key, start_links, v)[::-1]
+            elif v == t:
+                leg = graph.trace(goal_key, goal_links, u)
+            else:
+                key = graph.key_of(u)
+                leg = graph.trace(key, used[key][2][u], v)[::-1]
+            cells.extend(leg[1:])
+        coords = grid.coords
+        return tuple(coords[i] for i in cells)
+
+# Mapa de distancias (Dijkstra) hacia una celda, compartido por todos los enemigos.
+# Con `radius` solo cubre el cuadrado de ese radio alrededor del origen (mapas
+# grandes: el coste no depende del tamaño del mapa).
+class FlowField:
+    def __init__(self, grid, radius=None):
+        self.grid = grid
+        self.radius = radius
+        self.bounds = None  # (x0, y0, x1, y1) si el cuadrado no cubre todo el mapa
+        self.source = None
+        self.version = None
+        self.dist = None  # Indexado por y*width+x, como Grid.cells
+        self.rebuilds = 0
+    
+    def update(self, source):
+        if source == self.source and self.version == self.grid.version:
+            return
+        
+        changes = None
+        if source == self.source and self.version is not None:
+            changes = self.grid.changes_since(self.version)
+        
+        if changes is None:
+            self.rebuild(source)
+        else:
+            # Excavar solo abarata celdas: propagar las mejoras desde cada una
+            dist, neighbors, width = self.dist, self.grid.neighbors, self.grid.width
+            open_set = []
+            for x, y in changes:
+                i = y * width + x
+                d = dist[i] + 1
+                for n in neighbors[i]:
+                    if d < dist[n] and (self.bounds is None or self.contains(n)):
+                        dist[n] = d
+                        heapq.heappush(open_set, (d, n))
+            self.propagate(open_set)
+        self.version = self.grid.version
+    
+    def rebuild(self, source):
+        self.rebuilds += 1
+        self.source = source
+        x, y = source
+        r, w, h = self.radius, self.grid.width, self.grid.height
+        if r is None or (x - r <= 0 and y - r <= 0 and x + r >= w - 1 and y + r >= h - 1):
+            self.bounds = None
+            self.dist = [math.inf] * len(self.grid.cells)
+        else:
+            self.bounds = (max(0, x - r), max(0, y - r), min(w - 1, x + r), min(h - 1, y + r))
+            self.dist = SparseDistances()
+        i = self.grid.index(*source)
+        self.dist[i] = 0
+        self.propagate([(0, i)])
+    
+    def propagate(self, open_set):
+        # Dijkstra "hacia atrás": dist[c] es el coste de ir de c hasta el origen.
+        # Mismo modelo de costes que AStar: 1 por paso, +5 si hay que excavar.
+        dist, neighbors, tunnel = self.dist, self.grid.neighbors, self.grid.tunnel
+        bounded = self.bounds is not None
+        while open_set:
+            d, i = heapq.heappop(open_set)
+            if d > dist[i]:
+                continue
+            step = d + (1 if tunnel[i] else 6)
+            for n in neighbors[i]:
+                if step < dist[n] and (not bounded or self.contains(n)):
+                    dist[n] = step
+                    heapq.heappush(open_set, (step, n))
+    
+    def contains(self, i):
+        x0, y0, x1, y1 = self.bounds
+        width = self.grid.width
+        return x0 <= i % width <= x1 and y0 <= i // width <= y1
+    
+    def next_step(self, cell):
+        # Vecino que minimiza coste de entrada + distancia restante
+        i = self.grid.index(*cell)
+        best, best_cost = None, self.dist[i]
+        if best_cost == math.inf:
+            return None
+        dist, tunnel = self.dist, self.grid.tunnel
+        for n in self.grid.neighbors[i]:
+            cost = (1 if tunnel[n] else 6) + dist[n]
+            if cost <= best_cost:
+                best, best_cost = n, cost
+        return self.grid.coords[best] if best is not None else None
+    
+    def path_from(self, start, max_len):
+        # Seguir el campo hasta el origen, con como mucho `max_len` celdas
+        path = [start]
+        while path[-1] != self.source and len(path) < max_len:
+            step = self.next_step(path[-1])
+            if step is None:
+                return None
+            path.append(step)
+        return tuple(path) if path[-1] == self.source else None
+
+# Planificador incremental (D* Lite) para un enemigo. La búsqueda va hacia atrás
+# desde el objetivo, así que el enemigo puede moverse sin replanificar y las
+# excavaciones solo reparan los vértices afectados. Si el objetivo se mueve,
+# cambia la raíz del árbol y casi todo él deja de valer: repararlo costaba más
+# que una búsqueda nueva, así que se empieza de cero.
+class DStarLite:
+    def __init__(self, grid):
+        self.grid = grid
+        self.goal = None
+        self.start = None
+        self.version = None
+        self.nodes_expanded = 0
+    
+    def heuristic(self, a, b):
+        width = self.grid.width
+        return abs(a % width - b % width) + abs(a // width - b // width)
+    
+    def reset(self, start, goal):
+        self.start = self.last_start = start
+        self.goal = goal
+        self.km = 0
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.open = {}  # vértice -> clave vigente; el montón admite entradas obsoletas
+        self.heap = []
+        self.push(goal)
+        self.version = self.grid.version
+    
+    def calculate_key(self, s):
+        g, rhs = self.g.get(s, math.inf), self.rhs.get(s, math.inf)
+        best = g if g < rhs else rhs
+        width = self.grid.width
+        start = self.start
+        h = abs(start % width - s % width) + abs(start // width - s // width)
+        return (best + h + self.km, best)
+    
+    def push(self, s):
+        key = self.calculate_key(s)
+        if self.open.get(s) != key:
+            self.open[s] = key
+            heapq.heappush(self.heap, (key, s))
+    
+    def update_vertex(self, s):
+        if s != self.goal:
+            # Coste de entrar en el vecino (1, o 6 si hay que excavar) + su distancia
+            g, tunnel = self.g, self.grid.tunnel
+            best = math.inf
+            for n in self.grid.neighbors[s]:
+                cost = (1 if tunnel[n] else 6) + g.get(n, math.inf)
+                if cost < best:
+                    best = cost
+            self.rhs[s] = best
+        if self.g.get(s, math.inf) != self.rhs.get(s, math.inf):
+            self.push(s)
+        else:
+            self.open.pop(s, None)
+    
+    def compute_shortest_path(self, max_expansions=None):
+        # Devuelve False si se agotó `max_expansions` antes de terminar; el
+        # estado queda coherente y la siguiente llamada continúa donde lo dejó.
+        # Versión optimizada de D* Lite: entrar en `u` cuesta lo mismo desde
+        # cualquier vecino, así que al cambiar g[u] el rhs de cada vecino se
+        # corrige con una comparación en vez de recorrer todos sus vecinos.
+        g, rhs, open_set, heap = self.g, self.rhs, self.open, self.heap
+        neighbors, tunnel = self.grid.neighbors, self.grid.tunnel
+        start, goal = self.start, self.goal
+        inf = math.inf
+        expanded = 0
+        while heap:
+            key, u = heap[0]
+            if open_set.get(u) != key:
+                heapq.heappop(heap)  # Entrada obsoleta
+                continue
+            if key >= self.calculate_key(start) and rhs.get(start, inf) == g.get(start, inf):
+                break
+            if max_expansions is not None and expanded >= max_expansions:
+                return False
+            heapq.heappop(heap)
+            del open_set[u]
+            self.nodes_expanded += 1
+            expanded += 1
+            
+            new_key = self.calculate_key(u)
+            if key < new_key:
+                self.push(u)
+                continue
+            g_old, u_rhs = g.get(u, inf), rhs.get(u, inf)
+            cost = 1 if tunnel[u] else 6
+            if g_old > u_rhs:
+                # Sobreconsistente: u baja a su rhs y puede abaratar a sus vecinos
+                g[u] = u_rhs
+                through = u_rhs + cost
+                for p in neighbors[u]:
+                    if through < rhs.get(p, inf):
+                        rhs[p] = through
+                    if g.get(p, inf) != rhs.get(p, inf):
+                        self.push(p)
+                    else:
+                        open_set.pop(p, None)
+            else:
+                # Subconsistente: solo se recalculan los que dependían de u
+                g[u] = inf
+                through = g_old + cost
+                for p in neighbors[u]:
+                    if p != goal and rhs.get(p, inf) == through:
+                        self.update_vertex(p)
+                self.update_vertex(u)
+        return True
+    
+    def plan(self, start, goal):
+        return run_to_completion(self.plan_steps(start, goal))
+    
+    def plan_steps(self, start, goal, chunk=None):
+        # Generador: cede el control cada `chunk` nodos expandidos
+        grid = self.grid
+        if not grid.is_reachable(start, goal):
+            return None  # Otra zona: ni se busca
+        start, goal = grid.index(*start), grid.index(*goal)
+        if grid.cells[start] == 2:
+            return None
+        
+        changes = grid.changes_since(self.version) if self.goal is not None else None
+        if changes is None or goal != self.goal:
+            self.reset(start, goal)
+        else:
+            # El enemigo se movió: corregir las claves con km en vez de reordenar
+            self.km += self.heuristic(self.last_start, start)
+            self.start = self.last_start = start
+            
+            # Celdas excavadas: entrar en ellas es más barato para sus vecinos
+            for x, y in changes:
+                for p in grid.neighbors[grid.index(x, y)]:
+                    self.update_vertex(p)
+            self.version = grid.version
+        
+        expanded = self.nodes_expanded
+        while not self.compute_shortest_path(chunk):
+            yield chunk
+        profiler.count("dstar.nodes", self.nodes_expanded - expanded)
+        return self.extract_path()
+    
+    def extract_path(self):
+        g, tunnel, neighbors = self.g, self.grid.tunnel, self.grid.neighbors
+        current = self.start
+        if g.get(current, math.inf) == math.inf:
+            return None
+        coords = self.grid.coords
+        path = [coords[current]]
+        while current != self.goal:
+            best, best_cost = None, math.inf
+            for n in neighbors[current]:
+                cost = (1 if tunnel[n] else 6) + g.get(n, math.inf)
+                if cost < best_cost:
+                    best, best_cost = n, cost
+            if best is None:
+                return None
+            current = best
+            path.append(coords[current])
+        return tuple(path)
+
+# Resultado de plan_path cuando la búsqueda sigue en curso
+PATH_PENDING = object()
 
-# Nodos del Árbol de Comportamiento
+# Planificador de IA por frames: reparte los ticks del árbol de comportamiento
+# y limita el trabajo de búsqueda de caminos por frame. El presupuesto se mide
+# en nodos expandidos para que las repeticiones sigan siendo deterministas;
+# `node_cost` es lo que cuenta cada nodo (más en mapas grandes, donde expandir
+# es más caro). `budget_ms` añade un tope de tiempo real (a costa de ese
+# determinismo), y `pool` manda las búsquedas de A* a un PathWorkerPool (también).
+class AIScheduler:
+    LARGE_MAP_NODE_COST = 2  # Búferes en diccionarios y vecinos calculados al pedirlos
+    
+    def __init__(self, node_budget=2000, chunk=64, think_interval=4, near_distance=8, budget_ms=None,
+                 pool=None):
+        self.node_budget = node_budget
+        self.node_cost = 1
+        self.chunk = chunk
+        self.think_interval = think_interval
+        self.near_distance = near_distance
+        self.budget_ms = budget_ms
+        self.pool = pool
+        self.jobs = {}  # enemigo -> [inicio, objetivo, versión, generador, límites]
+        self.frame = 0
+        self.spent = 0
+        self.deadline = None
+    
+    def clear(self):
+        self.jobs.clear()
+        if self.pool is not None:
+            self.pool.clear()
+    
+    def cancel(self, enemy):
+        self.jobs.pop(enemy, None)
+        if self.pool is not None:
+            self.pool.cancel(enemy)
+    
+    def distance(self, enemy):
+        return abs(enemy.grid_x - enemy.player.grid_x) + abs(enemy.grid_y - enemy.player.grid_y)
+    
+    def begin_frame(self, frame):
+        self.frame = frame
+        self.spent = 0
+        self.deadline = None
+        if self.budget_ms is not None:
+            self.deadline = time.perf_counter() + self.budget_ms / 1000
+    
+    def should_think(self, enemy, index, distance=None):
+        # Los enemigos cercanos o bombeados piensan cada frame; el resto, por turnos
+        if distance is None:
+            distance = self.distance(enemy)
+        if enemy.pump_count > 0 or distance < self.near_distance:
+            return True
+        return (self.frame + index) % self.think_interval == 0
+    
+    def has_budget(self):
+        if self.spent >= self.node_budget:
+            return False
+        return self.deadline is None or time.perf_counter() < self.deadline
+    
+    def request(self, enemy, start, target, **limits):
+        # D* Lite guarda estado propio y no se puede copiar a otro proceso.
+        # En segundo plano las búsquedas no se acotan (`limits` de A*).
+        if self.pool is not None and enemy.planner is None:
+            return self.pool.request(enemy, start, target)
+        
+        job = self.jobs.get(enemy)
+        if job is not None and job[0] == start and job[1] == target and job[4] == limits:
+            return PATH_PENDING
+        
+        # Una petición nueva sustituye a la anterior del mismo enemigo
+        job = [start, target, enemy.grid.version, enemy.path_steps(start, target, self.chunk, **limits), limits]
+        self.jobs[enemy] = job
+        if self.has_budget():
+            # Primer trozo en el acto: las búsquedas cortas (o en caché) terminan ya
+            done, path = self.advance(job)
+            if done:
+                del self.jobs[enemy]
+                return path
+        return PATH_PENDING
+    
+    def run_now(self, enemy, start, target, **limits):
+        # Búsqueda corta que se resuelve en el acto (el tramo final de un camino
+        # al empalmarlo), a cuenta del presupuesto del frame: se corta donde se
+        # acabe. Con el pool o sin presupuesto no se hace (PATH_PENDING).
+        if self.pool is not None or not self.has_budget():
+            return PATH_PENDING
+        remaining = (self.node_budget - self.spent) // self.node_cost
+        if limits.get("max_expansions") is None or limits["max_expansions"] > remaining:
+            limits["max_expansions"] = remaining
+        job = [start, target, enemy.grid.version,
+               enemy.pathfinder.find_path_steps(start, target, self.chunk, **limits), limits]
+        while True:
+            done, path = self.advance(job)
+            if done:
+                return path
+    
+    def advance(self, job):
+        # Cada trozo de búsqueda se mide aparte (también el primero, que se
+        # hace dentro del árbol de comportamiento del enemigo)
+        started = profiler.start()
+        try:
+            self.spent += next(job[3]) * self.node_cost
+        except StopIteration as done:
+            return True, done.value
+        finally:
+            profiler.stop("ai.search", started)
+        return False, None
+    
+    def run(self):
+        if self.pool is not None:
+            self.pool.poll()
+        # Continuar las búsquedas pendientes, primero las de enemigos más cercanos
+        for enemy in sorted(self.jobs, key=self.distance):
+            job = self.jobs[enemy]
+            while self.has_budget():
+                done, path = self.advance(job)
+                if done:
+                    del self.jobs[enemy]
+                    enemy.receive_path(job[0], job[1], path, job[2])
+                    break
+            if not self.has_budget():
+                break
+
+# Búsquedas de A* en segundo plano (hilos o procesos). El terreno se comparte
+# como copias planas en memoria compartida: varias ranuras, una por versión
+# del grid, que no se reutilizan mientras haya búsquedas leyéndolas.
+class PathWorkerPool:
+    SLOTS = 4
+    
+    def __init__(self, grid, workers=None, use_processes=True):
+        # Importados aquí: solo hacen falta con el pool activado
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        from multiprocessing import shared_memory
+        self.grid = grid
+        self.size = grid.width * grid.height
+        self.shm = shared_memory.SharedMemory(create=True, size=self.size * self.SLOTS)
+        self.slot_versions = [None] * self.SLOTS
+        self.slot_users = [0] * self.SLOTS
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=workers)
+        self.jobs = {}  # enemigo -> (inicio, objetivo, versión, ranura, futuro)
+        self.abandoned = []  # Trabajos sustituidos que aún ocupan una ranura
+    
+    def snapshot_slot(self):
+        # Ranura con la versión actual del grid; copiarla si no existe
+        version = self.grid.version
+        if version in self.slot_versions:
+            return self.slot_versions.index(version)
+        for slot, users in enumerate(self.slot_users):
+            if users == 0:
+                offset = slot * self.size
+                self.shm.buf[offset:offset + self.size] = self.grid.cells
+                self.slot_versions[slot] = version
+                return slot
+        return None  # Todas ocupadas: se reintentará en otro frame
+    
+    def request(self, enemy, start, target):
+        path = self.grid.path_cache.get(start, target)
+        if path is not PathCache.MISS:
+            return path
+        
+        job = self.jobs.get(enemy)
+        if job is not None:
+            if job[0] == start and job[1] == target:
+                return PATH_PENDING
+            self.cancel(enemy)
+        
+        slot = self.snapshot_slot()
+        if slot is None:
+            return PATH_PENDING
+        self.slot_users[slot] += 1
+        future = self.executor.submit(find_path_in_snapshot, self.shm.name, slot * self.size,
+                                      self.grid.width, self.grid.height, start, target)
+        self.jobs[enemy] = (start, target, self.grid.version, slot, future)
+        return PATH_PENDING
+    
+    def cancel(self, enemy):
+        job = self.jobs.pop(enemy, None)
+        if job is not None:
+            job[4].cancel()
+            self.abandoned.append(job)
+    
+    def clear(self):
+        for enemy in list(self.jobs):
+            self.cancel(enemy)
+    
+    def poll(self):
+        # Entregar los resultados terminados sin bloquear nunca el bucle
+        for enemy, job in list(self.jobs.items()):
+            start, target, version, slot, future = job
+            if not future.done():
+                continue
+            del self.jobs[enemy]
+            self.slot_users[slot] -= 1
+            path = future.result()
+            # Descartar si el terreno cambió de forma que el camino ya no sirve
+            if self.grid.is_path_current(path, version):
+                self.grid.path_cache.put(start, target, path, version)
+                enemy.receive_path(start, target, path, version)
+        
+        for job in self.abandoned[:]:
+            if job[4].done():
+                self.abandoned.remove(job)
+                self.slot_users[job[3]] -= 1
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        # Con hilos, las copias locales viven en este mismo proceso
+        for key in [key for key in _worker_grids if key[0] == self.shm.name]:
+            _worker_grids.pop(key)[0].close()
+        self.shm.close()
+        self.shm.unlink()
+
+# Estado de cada hilo/proceso de búsqueda: memoria compartida y grid local
+_worker_grids = {}
+
+def find_path_in_snapshot(shm_name, offset, width, height, start, goal):
+    from multiprocessing import shared_memory
+    key = (shm_name, threading.get_ident())
+    state = _worker_grids.get(key)
+    if state is None:
+        # El rastreador de recursos es común a todos los procesos del pool:
+        # la memoria se libera una sola vez, en PathWorkerPool.shutdown()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        state = _worker_grids[key] = (shm, Grid(random.Random(0), width, height))
+    shm, grid = state
+    # Si las rocas no cambiaron, load() no recalcula los vecinos
+    grid.load(shm.buf[offset:offset + width * height])
+    return AStar(grid).search(start, goal)
+
+# Estados de los nodos. FAILURE es falso y SUCCESS/RUNNING verdaderos, así
+# que las condiciones pueden devolver bool. RUNNING: la acción sigue en curso
+# (camino a medias o pendiente) y no hace falta replanificar.
+BT_FAILURE = 0
+BT_SUCCESS = 1
+BT_RUNNING = 2
+
+# Nodos del Árbol de Comportamiento. Las hojas llevan el nombre de un método
+# del actor (o una función que recibe el actor).
 class BTNode:
     def tick(self, actor):
         pass
@@ -209,9 +1906,10 @@ class BTSelector(BTNode):
     
     def tick(self, actor):
         for child in self.children:
-            if child.tick(actor):
-                return True
-        return False
+            status = child.tick(actor)
+            if status != BT_FAILURE:
+                return status
+        return BT_FAILURE
 
 class BTSequence(BTNode):
     def __init__(self, children):
@@ -219,37 +1917,119 @@ class BTSequence(BTNode):
     
     def tick(self, actor):
         for child in self.children:
-            if not child.tick(actor):
-                return False
-        return True
+            status = child.tick(actor)
+            if status != BT_SUCCESS:
+                return status
+        return BT_SUCCESS
 
 class BTCondition(BTNode):
     def __init__(self, condition_func):
         self.condition_func = condition_func
     
     def tick(self, actor):
-        return self.condition_func(actor)
+        func = self.condition_func
+        return getattr(actor, func)() if isinstance(func, str) else func(actor)
 
 class BTAction(BTNode):
     def __init__(self, action_func):
         self.action_func = action_func
     
     def tick(self, actor):
-        return self.action_func(actor)
+        func = self.action_func
+        return getattr(actor, func)() if isinstance(func, str) else func(actor)
+
+# Árbol compilado una vez por clase de enemigo y compartido por todas sus
+# instancias. Los compuestos desaparecen: cada hoja guarda a qué hoja saltar
+# si tiene éxito y a cuál si falla (o un final, índice negativo), y un tick
+# es un bucle sobre listas planas. RUNNING termina siempre el tick.
+class BehaviorTree:
+    def __init__(self, root):
+        self.leaves = []
+        self.on_success = []
+        self.on_failure = []
+        self.bound = {}  # clase -> funciones de las hojas
+        self.entry = self.compile(root, -1 - BT_SUCCESS, -1 - BT_FAILURE)
+    
+    def compile(self, node, success, failure):
+        # Devuelve la primera hoja del subárbol; los hijos se compilan del
+        # último al primero para conocer ya su continuación
+        if isinstance(node, BTSequence):
+            for child in reversed(node.children):
+                success = self.compile(child, success, failure)
+            return success
+        if isinstance(node, BTSelector):
+            for child in reversed(node.children):
+                failure = self.compile(child, success, failure)
+            return failure
+        if isinstance(node, BTCondition):
+            leaf = node.condition_func
+        elif isinstance(node, BTAction):
+            leaf = node.action_func
+        else:
+            raise TypeError(f"Nodo no compilable: {node!r}")
+        self.leaves.append(leaf)
+        self.on_success.append(success)
+        self.on_failure.append(failure)
+        return len(self.leaves) - 1
+    
+    def bind(self, cls):
+        funcs = [getattr(cls, leaf) if isinstance(leaf, str) else leaf for leaf in self.leaves]
+        self.bound[cls] = funcs
+        return funcs
+    
+    def tick(self, actor):
+        actor.blackboard.refresh()
+        funcs = self.bound.get(actor.__class__) or self.bind(actor.__class__)
+        on_success = self.on_success
+        on_failure = self.on_failure
+        index = self.entry
+        while index >= 0:
+            status = funcs[index](actor)
+            if status == BT_RUNNING:
+                return BT_RUNNING
+            index = on_success[index] if status else on_failure[index]
+        return -1 - index
+
+# Datos derivados que consultan las condiciones, calculados una vez por tick:
+# la posición relativa del jugador y, solo si se pide, la línea de visión.
+class Blackboard:
+    def __init__(self, actor):
+        self.actor = actor
+        self.refresh()
+    
+    def refresh(self):
+        actor = self.actor
+        self.dx = actor.player.grid_x - actor.grid_x
+        self.dy = actor.player.grid_y - actor.grid_y
+        self.distance = abs(self.dx) + abs(self.dy)
+        self._line_clear = None
+    
+    @property
+    def line_clear(self):
+        if self._line_clear is None:
+            actor = self.actor
+            self._line_clear = actor.grid.is_line_clear((actor.grid_x, actor.grid_y),
+                                                        (actor.player.grid_x, actor.player.grid_y))
+        return self._line_clear
 
 # Clase del jugador
 class Player(pygame.sprite.Sprite):
+    SIZE = TILE_SIZE - 2
+    FLOW_RADIUS = 24  # Alcance del campo de distancias (en mapas más grandes)
+    
+    @property
+    def image(self):
+        return sprite_atlas.player(self.SIZE)
+    
     def __init__(self, grid):
         pygame.sprite.Sprite.__init__(self)
         self.grid = grid
         # Posición inicial en el centro superior del mapa
-        self.grid_x = GRID_WIDTH // 2
+        self.grid_x = grid.width // 2
         self.grid_y = 1
         self.grid.dig(self.grid_x, self.grid_y)
         
-        self.image = pygame.Surface((TILE_SIZE - 2, TILE_SIZE - 2))
-        self.image.fill(RED)
-        self.rect = self.image.get_rect()
+        self.rect = pygame.Rect(0, 0, self.SIZE, self.SIZE)
         self.rect.centerx = self.grid_x * TILE_SIZE + TILE_SIZE // 2
         self.rect.centery = self.grid_y * TILE_SIZE + TILE_SIZE // 2
         
@@ -259,26 +2039,33 @@ class Player(pygame.sprite.Sprite):
         self.lives = 3
         self.pumping = False
         self.pump_target = None
-        self.dig_sound = load_sound("dig.mp3")  # Asegúrate de tener este archivo
+        self.dig_sound = sound_bank.get("dig.mp3", max_instances=2)
+        # Distancias hacia el jugador, compartidas por todos los perseguidores
+        self.flow_field = FlowField(grid, self.FLOW_RADIUS)
+    
+    def get_flow_field(self):
+        self.flow_field.update((self.grid_x, self.grid_y))
+        return self.flow_field
     
-    def update(self, current_time):
-        keys = pygame.key.get_pressed()
+    def update(self, current_time, buttons=None):
+        if buttons is None:
+            buttons = read_keyboard()
         
         # Control de movimiento con temporizador para no moverse demasiado rápido
         if current_time - self.move_timer > self.move_delay:
             new_x, new_y = self.grid_x, self.grid_y
             moved = False
             
-            if keys[pygame.K_LEFT] and self.grid_x > 0:
+            if buttons & INPUT_LEFT and self.grid_x > 0:
                 new_x -= 1
                 moved = True
-            elif keys[pygame.K_RIGHT] and self.grid_x < GRID_WIDTH - 1:
+            elif buttons & INPUT_RIGHT and self.grid_x < self.grid.width - 1:
                 new_x += 1
                 moved = True
-            elif keys[pygame.K_UP] and self.grid_y > 0:
+            elif buttons & INPUT_UP and self.grid_y > 0:
                 new_y -= 1
                 moved = True
-            elif keys[pygame.K_DOWN] and self.grid_y < GRID_HEIGHT - 1:
+            elif buttons & INPUT_DOWN and self.grid_y < self.grid.height - 1:
                 new_y += 1
                 moved = True
             
@@ -296,19 +2083,17 @@ class Player(pygame.sprite.Sprite):
                 self.rect.centery = self.grid_y * TILE_SIZE + TILE_SIZE // 2
                 self.move_timer = current_time
     
-    def pump(self, enemies):
-        keys = pygame.key.get_pressed()
+    def pump(self, enemies, buttons=None):
+        if buttons is None:
+            buttons = read_keyboard()
         
-        if keys[pygame.K_SPACE]:
+        if buttons & INPUT_PUMP:
             if not self.pumping:
-                # Buscar enemigo cercano
-                for enemy in enemies:
-                    dx = abs(enemy.grid_x - self.grid_x)
-                    dy = abs(enemy.grid_y - self.grid_y)
-                    if dx <= 1 and dy <= 1:  # Enemigo adyacente
-                        self.pumping = True
-                        self.pump_target = enemy
-                        break
+                # Buscar enemigo adyacente en el índice de ocupación
+                enemy = self.grid.occupancy.first_adjacent(self.grid_x, self.grid_y)
+                if enemy is not None:
+                    self.pumping = True
+                    self.pump_target = enemy
         else:
             self.pumping = False
             self.pump_target = None
@@ -319,122 +2104,246 @@ class Player(pygame.sprite.Sprite):
             # Sumar puntos por bombear
             self.score += 5
     
-    def draw(self, surface):
+    def draw(self, surface, offset=(0, 0)):
         # En una versión completa, aquí cambiarías la imagen según la dirección, etc.
-        pygame.draw.rect(surface, RED, self.rect)
+        # `offset` pasa de coordenadas del mundo a la pantalla (Camera.offset).
+        # Devuelve la zona de pantalla modificada
+        rect = self.rect.move(offset)
+        dirty = surface.blit(self.image, rect)
         
         # Si está bombeando, dibujar la manguera
         if self.pumping and self.pump_target:
-            pygame.draw.line(surface, WHITE, 
-                             (self.rect.centerx, self.rect.centery),
-                             (self.pump_target.rect.centerx, self.pump_target.rect.centery), 3)
+            dirty = dirty.union(pygame.draw.line(surface, WHITE, rect.center,
+                             self.pump_target.rect.move(offset).center, 3))
+        return dirty
 
 # Clase base para enemigos
 class Enemy(pygame.sprite.Sprite):
-    def __init__(self, grid, player, x=None, y=None, color=ORANGE):
+    sprite_name = "enemy"  # Fotogramas en el atlas (y <nombre>.png opcional)
+    color = ORANGE
+    max_pump = 3  # Cuántos bombeos aguanta antes de explotar
+    
+    # Árbol de comportamiento básico; las subclases definen el suyo
+    behavior_tree = BehaviorTree(BTSelector([
+        # Si está siendo bombeado, intentar huir
+        BTSequence([BTCondition("is_pumped"), BTAction("flee")]),
+        # Si el jugador está cerca, perseguirlo
+        BTSequence([BTCondition("is_player_nearby"), BTAction("chase_player")]),
+        # De lo contrario, patrullar
+        BTAction("patrol"),
+    ]))
+    
+    MAX_BLOCKED_MOVES = 2  # Esperas antes de apartarse de otro enemigo
+    MAX_SPAWN_ATTEMPTS = 200  # Intentos de encontrar una celda libre al aparecer
+    FLEE_SEARCH_NODES = 400  # Huir: búsqueda acotada; si no llega, el mejor camino parcial
+    SPLICE_DISTANCE = 2  # Desplazamiento del objetivo que se repara sin buscar de cero
+    SPLICE_BACKTRACK = 2  # Pasos del final del camino que se vuelven a buscar
+    PATROL_RADIUS = 24  # Puntos de patrulla cerca del enemigo (en 25x19, todo el mapa)
+    
+    def __init__(self, grid, player, x=None, y=None, color=None):
         pygame.sprite.Sprite.__init__(self)
         self.grid = grid
         self.player = player
+        self.rng = grid.rng
         self.pathfinder = AStar(grid)
+        self.planner = None  # DStarLite si la partida usa planificación incremental
+        self.scheduler = None  # AIScheduler si la búsqueda se reparte entre frames
+        self.store = None  # EnemyStore que refleja su estado (modo estrés)
+        self.store_slot = None
         
         # Posición inicial aleatoria (si no se especifica)
         if x is None or y is None:
             valid_pos = False
+            attempts = 0
             while not valid_pos:
-                self.grid_x = random.randint(1, GRID_WIDTH - 2)
-                self.grid_y = random.randint(GRID_HEIGHT // 2, GRID_HEIGHT - 2)
-                # Evitar posicionar sobre rocas o muy cerca del jugador
+                self.grid_x = self.rng.randint(1, grid.width - 2)
+                self.grid_y = self.rng.randint(grid.height // 2, grid.height - 2)
+                attempts += 1
+                # Evitar rocas, posiciones muy cerca del jugador y otros enemigos
+                # (si el mapa está lleno, compartir celda al aparecer)
                 valid_pos = (not self.grid.is_rock(self.grid_x, self.grid_y) and
                             (abs(self.grid_x - player.grid_x) > 5 or
-                             abs(self.grid_y - player.grid_y) > 5))
+                             abs(self.grid_y - player.grid_y) > 5) and
+                            (attempts > self.MAX_SPAWN_ATTEMPTS or
+                             not self.grid.occupancy.is_occupied(self.grid_x, self.grid_y)))
         else:
             self.grid_x, self.grid_y = x, y
         
         self.grid.dig(self.grid_x, self.grid_y)  # Crear un túnel en la posición inicial
+        self.grid.occupancy.add(self)
         
-        self.image = pygame.Surface((TILE_SIZE - 4, TILE_SIZE - 4))
-        self.image.fill(color)
-        self.rect = self.image.get_rect()
+        if color is not None:
+            self.color = color
+        size = self.body_size(0)
+        self.rect = pygame.Rect(0, 0, size, size)
         self.rect.centerx = self.grid_x * TILE_SIZE + TILE_SIZE // 2
         self.rect.centery = self.grid_y * TILE_SIZE + TILE_SIZE // 2
         
         self.move_timer = 0
         self.move_delay = 300  # ms entre movimientos (más lento que el jugador)
+        self.blocked_moves = 0  # Movimientos seguidos bloqueados por otro enemigo
         self.path = []
+        self.path_version = grid.version
         self.state = "patrol"
         self.patrol_points = []
         self.current_patrol_index = 0
         self.pump_count = 0
-        self.max_pump = 3  # Cuántos bombeos aguanta antes de explotar
+        self.current_time = 0  # Tiempo de la simulación en el último update
         
         # Crear puntos de patrulla aleatorios
         self.generate_patrol_points()
         
-        # Comportamiento usando BT
-        self.behavior_tree = self.create_behavior_tree()
+        # Comportamiento usando BT (árbol compartido por la clase)
+        self.blackboard = Blackboard(self)
     
     def generate_patrol_points(self):
-        # Generar 3-5 puntos aleatorios para patrullar
-        num_points = random.randint(3, 5)
+        # Generar 3-5 puntos aleatorios para patrullar, a como mucho
+        # PATROL_RADIUS celdas: en mapas grandes las búsquedas siguen siendo
+        # locales en vez de cruzar el mapa
+        num_points = self.rng.randint(3, 5)
+        r = self.PATROL_RADIUS
+        x0, x1 = max(1, self.grid_x - r), min(self.grid.width - 2, self.grid_x + r)
+        y0, y1 = max(1, self.grid_y - r), min(self.grid.height - 2, self.grid_y + r)
         for _ in range(num_points):
             while True:
-                px = random.randint(1, GRID_WIDTH - 2)
-                py = random.randint(1, GRID_HEIGHT - 2)
+                px = self.rng.randint(x0, x1)
+                py = self.rng.randint(y0, y1)
                 if not self.grid.is_rock(px, py):
                     self.patrol_points.append((px, py))
                     break
     
-    def create_behavior_tree(self):
-        # Crea y retorna el árbol de comportamiento específico para cada tipo de enemigo
-        # Esta es una implementación básica que se sobrescribirá en las subclases
-        return BTSelector([
-            # Si está siendo bombeado, intentar huir
-            BTSequence([
-                BTCondition(lambda actor: actor.pump_count > 0),
-                BTAction(lambda actor: actor.flee())
-            ]),
-            # Si el jugador está cerca, perseguirlo
-            BTSequence([
-                BTCondition(lambda actor: actor.is_player_nearby()),
-                BTAction(lambda actor: actor.chase_player())
-            ]),
-            # De lo contrario, patrullar
-            BTAction(lambda actor: actor.patrol())
-        ])
+    def is_pumped(self):
+        return self.pump_count > 0
     
     def is_player_nearby(self):
         # Considerar "cerca" si está a menos de 5 tiles
-        dx = abs(self.player.grid_x - self.grid_x)
-        dy = abs(self.player.grid_y - self.grid_y)
-        return dx + dy < 5
+        return self.blackboard.distance < 5
+    
+    def set_path(self, path, version=None):
+        # El camino se guarda como deque: avanzar un paso es popleft(), sin
+        # copiar el resto (los caminos de la caché son tuplas compartidas)
+        self.path = deque(path) if path else None
+        self.path_version = self.grid.version if version is None else version
+    
+    def follows_path_to(self, target):
+        # ¿El camino actual sigue llevando a `target` y sigue siendo válido?
+        if not self.path or self.path[-1] != target:
+            return False
+        if self.path[0] != (self.grid_x, self.grid_y):
+            return False
+        if not self.grid.is_path_current(self.path, self.path_version):
+            return False
+        self.path_version = self.grid.version
+        return True
+    
+    def plan_path(self, target, **limits):
+        # Camino desde la posición actual con el planificador del enemigo.
+        # Con AIScheduler puede devolver PATH_PENDING (se resolverá en otro frame).
+        # `limits` acota la búsqueda (ver AStar.search_steps); D* Lite no sabe
+        # acotarla, así que las búsquedas acotadas se hacen siempre con A*.
+        start = (self.grid_x, self.grid_y)
+        if self.scheduler is not None:
+            return self.scheduler.request(self, start, target, **limits)
+        if self.planner is not None and not limits:
+            return self.planner.plan(start, target)
+        return self.pathfinder.find_path(start, target, **limits)
+    
+    def path_steps(self, start, target, chunk, **limits):
+        # Búsqueda troceada para el planificador por frames
+        if self.planner is not None and not limits:
+            return self.planner.plan_steps(start, target, chunk)
+        return self.pathfinder.find_path_steps(start, target, chunk, **limits)
+    
+    def splice_path(self, target, **limits):
+        # Si el objetivo solo se desplazó un poco, conservar el principio del
+        # camino actual y buscar de nuevo solo el tramo final, con los mismos
+        # límites que la búsqueda completa. D* Lite ya reaprovecha su
+        # búsqueda, así que solo se hace con A*.
+        path = self.path
+        if self.planner is not None or not path or len(path) <= self.SPLICE_BACKTRACK + 1:
+            return False
+        end = path[-1]
+        if abs(end[0] - target[0]) + abs(end[1] - target[1]) > self.SPLICE_DISTANCE:
+            return False
+        if path[0] != (self.grid_x, self.grid_y) or not self.grid.is_path_current(path, self.path_version):
+            return False
+        
+        join = len(path) - 1 - self.SPLICE_BACKTRACK
+        if self.scheduler is not None:
+            # Dentro del presupuesto del frame; con el pool, la búsqueda completa
+            tail = self.scheduler.run_now(self, path[join], target, **limits)
+            if tail is PATH_PENDING:
+                return False
+        else:
+            tail = self.pathfinder.find_path(path[join], target, **limits)
+        if not tail or tail[-1] != target or not set(islice(path, join)).isdisjoint(tail):
+            return False  # Sin camino (o parcial), o el tramo nuevo vuelve sobre sus pasos
+        for _ in range(self.SPLICE_BACKTRACK + 1):
+            path.pop()
+        path.extend(tail)
+        self.path_version = self.grid.version
+        return True
+    
+    def replan(self, target, **limits):
+        # Pedir un camino nuevo. Devuelve False si quedó pendiente: mientras
+        # tanto se sigue el camino anterior.
+        if self.splice_path(target, **limits):
+            return True
+        path = self.plan_path(target, **limits)
+        if path is PATH_PENDING:
+            return False
+        self.set_path(path)
+        return True
+    
+    def receive_path(self, start, target, path, version):
+        # Resultado de una búsqueda repartida entre frames
+        current = (self.grid_x, self.grid_y)
+        if path and current != start:
+            if current not in path:
+                return  # Obsoleto: el enemigo ya no está en el camino
+            path = path[path.index(current):]
+        self.set_path(path, version)
     
     def chase_player(self):
         self.state = "chase"
         target = (self.player.grid_x, self.player.grid_y)
-        self.path = self.pathfinder.find_path((self.grid_x, self.grid_y), target)
-        return True
+        if self.planner is not None:
+            # Camino aún válido o búsqueda pendiente: seguir sin replanificar
+            if self.follows_path_to(target) or not self.replan(target):
+                return BT_RUNNING
+            return BT_SUCCESS
+        
+        # Un solo paso leído del campo de distancias compartido
+        field = self.player.get_flow_field()
+        current = (self.grid_x, self.grid_y)
+        step = field.next_step(current)
+        self.set_path((current, step) if step else None)
+        return BT_SUCCESS
     
     def patrol(self):
         self.state = "patrol"
         if not self.patrol_points:
             self.generate_patrol_points()
-            return False
+            return BT_FAILURE
         
-        if not self.path or len(self.path) <= 1:
-            # Ir al siguiente punto de patrulla
-            target = self.patrol_points[self.current_patrol_index]
-            self.path = self.pathfinder.find_path((self.grid_x, self.grid_y), target)
-            
-            if not self.path:  # Si no se puede llegar al punto, elegir otro
-                self.current_patrol_index = (self.current_patrol_index + 1) % len(self.patrol_points)
-                return False
-            
-            # Si llegamos al punto de patrulla, ir al siguiente
-            if len(self.path) <= 1:
-                self.current_patrol_index = (self.current_patrol_index + 1) % len(self.patrol_points)
-                return True
+        if self.path and len(self.path) > 1:
+            return BT_RUNNING  # De camino al punto actual
         
-        return True
+        # Ir al siguiente punto de patrulla
+        target = self.patrol_points[self.current_patrol_index]
+        if not self.replan(target):
+            return BT_RUNNING
+        
+        if not self.path:  # Si no se puede llegar al punto, elegir otro
+            self.current_patrol_index = (self.current_patrol_index + 1) % len(self.patrol_points)
+            return BT_FAILURE
+        
+        # Si llegamos al punto de patrulla, ir al siguiente
+        if len(self.path) <= 1:
+            self.current_patrol_index = (self.current_patrol_index + 1) % len(self.patrol_points)
+            return BT_SUCCESS
+        
+        return BT_RUNNING
     
     def flee(self):
         # Intentar alejarse del jugador
@@ -449,60 +2358,79 @@ class Enemy(pygame.sprite.Sprite):
         dx = int(dx * 8 / dist)
         dy = int(dy * 8 / dist)
         
-        target_x = min(max(1, self.grid_x + dx), GRID_WIDTH - 2)
-        target_y = min(max(1, self.grid_y + dy), GRID_HEIGHT - 2)
+        target_x = min(max(1, self.grid_x + dx), self.grid.width - 2)
+        target_y = min(max(1, self.grid_y + dy), self.grid.height - 2)
         
-        self.path = self.pathfinder.find_path((self.grid_x, self.grid_y), (target_x, target_y))
+        target = (target_x, target_y)
+        if self.follows_path_to(target):
+            return BT_RUNNING
+        if not self.replan(target, max_expansions=self.FLEE_SEARCH_NODES, partial=True):
+            return BT_RUNNING  # Camino pendiente: no moverse al azar mientras tanto
         
         # Si no se puede huir, moverse aleatoriamente
         if not self.path:
-            directions = [(0, -1), (1, 0), (0, 1), (-1, 0)]
-            random.shuffle(directions)
-            
-            for dx, dy in directions:
-                nx, ny = self.grid_x + dx, self.grid_y + dy
-                if (self.grid.is_valid_position(nx, ny) and 
-                    not self.grid.is_rock(nx, ny)):
-                    self.grid_x, self.grid_y = nx, ny
-                    self.rect.centerx = self.grid_x * TILE_SIZE + TILE_SIZE // 2
-                    self.rect.centery = self.grid_y * TILE_SIZE + TILE_SIZE // 2
-                    return True
+            options = self.free_neighbors()
+            if options:
+                self.move_to(*self.rng.choice(options))
+                return BT_SUCCESS
         
-        return bool(self.path)
+        return BT_SUCCESS if self.path else BT_FAILURE
     
     def get_pumped(self):
         self.pump_count += 1
-        # Hinchar visualmente
-        scale = 1 + (self.pump_count * 0.2)
-        new_size = int((TILE_SIZE - 4) * scale)
-        self.image = pygame.Surface((new_size, new_size))
-        self.image.fill(self.image.get_at((0, 0)))  # Mantener el color original
-        self.rect = self.image.get_rect(center=self.rect.center)
+        if self.store is not None:
+            self.store.pump_count[self.store_slot] = self.pump_count
+        # Hinchar visualmente (el fotograma lo da el atlas)
+        center = self.rect.center
+        self.rect.width = self.rect.height = self.body_size(self.pump_count)
+        self.rect.center = center
     
-    def update(self, current_time):
-        # Actualizar según el árbol de comportamiento
-        self.behavior_tree.tick(self)
+    def update(self, current_time, think=True):
+        self.current_time = current_time
+        
+        # Actualizar según el árbol de comportamiento (el planificador puede
+        # saltarse frames de enemigos lejanos: `think` a False)
+        if think:
+            started = profiler.start()
+            self.behavior_tree.tick(self)
+            profiler.stop("enemy.bt", started)
         
         # Explotar si está demasiado bombeado
         if self.pump_count >= self.max_pump:
             return True  # Indicar que debe ser eliminado
         
+        started = profiler.start()
+        self.move(current_time)
+        profiler.stop("enemy.move", started)
+        return False  # No eliminar
+    
+    def move(self, current_time):
         # Movimiento según el camino calculado
         if current_time - self.move_timer > self.move_delay:
             if self.path and len(self.path) > 1:
-                # Tomar el siguiente punto del camino
+                # Tomar el siguiente punto del camino, salvo que otro enemigo
+                # lo ocupe: entonces esperar y, si sigue bloqueado, apartarse
                 next_pos = self.path[1]
-                self.path = self.path[1:]
+                if self.grid.occupancy.is_occupied(*next_pos, ignore=self):
+                    self.blocked_moves += 1
+                    if self.blocked_moves >= self.MAX_BLOCKED_MOVES:
+                        self.step_aside()
+                    self.move_timer = current_time
+                    if self.store is not None:
+                        self.store.move_timer[self.store_slot] = current_time
+                    return
+                self.blocked_moves = 0
+                self.path.popleft()
                 
                 # Excavar si es necesario
                 if not self.grid.is_tunnel(*next_pos):
                     self.grid.dig(*next_pos)
                 
                 # Mover al enemigo
-                self.grid_x, self.grid_y = next_pos
-                self.rect.centerx = self.grid_x * TILE_SIZE + TILE_SIZE // 2
-                self.rect.centery = self.grid_y * TILE_SIZE + TILE_SIZE // 2
+                self.move_to(*next_pos)
                 self.move_timer = current_time
+                if self.store is not None:
+                    self.store.move_timer[self.store_slot] = current_time
             
             # Si está persiguiendo y perdimos el camino, recalcular
             elif self.state == "chase" or self.state == "flee":
@@ -510,119 +2438,122 @@ class Enemy(pygame.sprite.Sprite):
                     self.chase_player()
                 else:
                     self.flee()
-        
-        return False  # No eliminar
     
-    def draw(self, surface):
-        pygame.draw.rect(surface, self.image.get_at((0, 0)), self.rect)
-        
-        # Dibujar ojos
-        eye_radius = max(2, int(self.rect.width / 10))
-        eye_offset = max(2, int(self.rect.width / 5))
-        
-        pygame.draw.circle(surface, WHITE, 
-                          (self.rect.centerx - eye_offset, self.rect.centery - eye_offset), 
-                          eye_radius)
-        pygame.draw.circle(surface, WHITE, 
-                          (self.rect.centerx + eye_offset, self.rect.centery - eye_offset), 
-                          eye_radius)
+    def move_to(self, x, y):
+        self.grid.occupancy.move(self, x, y)
+        self.grid_x, self.grid_y = x, y
+        if self.store is not None:
+            self.store.xs[self.store_slot] = x
+            self.store.ys[self.store_slot] = y
+        self.rect.centerx = x * TILE_SIZE + TILE_SIZE // 2
+        self.rect.centery = y * TILE_SIZE + TILE_SIZE // 2
+    
+    def free_neighbors(self):
+        # Celdas vecinas transitables sin otro enemigo
+        occupancy = self.grid.occupancy
+        return [cell for cell in self.grid.neighbor_cells[self.grid.index(self.grid_x, self.grid_y)]
+                if not occupancy.is_occupied(*cell)]
+    
+    def step_aside(self):
+        # Deshacer un bloqueo (p. ej. dos enemigos de frente en un túnel):
+        # ir a una celda libre y olvidar el camino para recalcularlo
+        options = self.free_neighbors()
+        if options:
+            x, y = self.rng.choice(options)
+            if not self.grid.is_tunnel(x, y):
+                self.grid.dig(x, y)
+            self.move_to(x, y)
+        self.set_path(None)
+        self.blocked_moves = 0
+    
+    @staticmethod
+    def body_size(pump_count):
+        # Lado del cuerpo: un 20% más grande por cada bombeo
+        return int((TILE_SIZE - 4) * (1 + pump_count * 0.2))
+    
+    @property
+    def image(self):
+        return sprite_atlas.enemy(self.sprite_name, self.color, self.pump_count, self.rect.width)
+    
+    def draw(self, surface, offset=(0, 0)):
+        # Devuelve la zona de pantalla modificada (los ojos quedan dentro del cuerpo)
+        return surface.blit(self.image, self.rect.move(offset))
 
 # Subclases específicas de enemigos con comportamientos diferentes
 class Pooka(Enemy):
+    sprite_name = "pooka"
+    color = ORANGE
+    
+    behavior_tree = BehaviorTree(BTSelector([
+        # Si está siendo bombeado, intentar huir
+        BTSequence([BTCondition("is_pumped"), BTAction("flee")]),
+        # Si el jugador está muy cerca, perseguirlo agresivamente
+        BTSequence([BTCondition("is_player_very_close"), BTAction("chase_player")]),
+        # Si el jugador está cerca, perseguirlo con cautela
+        BTSequence([BTCondition("is_player_nearby"), BTAction("cautious_chase")]),
+        # De lo contrario, patrullar
+        BTAction("patrol"),
+    ]))
+    
     def __init__(self, grid, player, x=None, y=None):
-        super().__init__(grid, player, x, y, ORANGE)
+        super().__init__(grid, player, x, y)
         self.move_delay = 250  # Ligeramente más rápido
     
-    def create_behavior_tree(self):
-        return BTSelector([
-            # Si está siendo bombeado, intentar huir
-            BTSequence([
-                BTCondition(lambda actor: actor.pump_count > 0),
-                BTAction(lambda actor: actor.flee())
-            ]),
-            # Si el jugador está muy cerca, perseguirlo agresivamente
-            BTSequence([
-                BTCondition(lambda actor: actor.is_player_very_close()),
-                BTAction(lambda actor: actor.chase_player())
-            ]),
-            # Si el jugador está cerca, perseguirlo con cautela
-            BTSequence([
-                BTCondition(lambda actor: actor.is_player_nearby()),
-                BTAction(lambda actor: actor.cautious_chase())
-            ]),
-            # De lo contrario, patrullar
-            BTAction(lambda actor: actor.patrol())
-        ])
-    
     def is_player_very_close(self):
-        dx = abs(self.player.grid_x - self.grid_x)
-        dy = abs(self.player.grid_y - self.grid_y)
-        return dx + dy < 3
+        return self.blackboard.distance < 3
     
     def cautious_chase(self):
         # Solo perseguir si hay un camino directo
         self.state = "cautious"
-        target = (self.player.grid_x, self.player.grid_y)
-        path = self.pathfinder.find_path((self.grid_x, self.grid_y), target)
+        if self.planner is not None:
+            target = (self.player.grid_x, self.player.grid_y)
+            if self.follows_path_to(target):
+                return BT_RUNNING
+            # No perseguir demasiado lejos: como mucho 7 celdas
+            path = self.plan_path(target, max_length=7)
+            if path is PATH_PENDING:
+                return BT_RUNNING
+        else:
+            field = self.player.get_flow_field()
+            path = field.path_from((self.grid_x, self.grid_y), 7)
         
-        if path and len(path) < 8:  # No perseguir demasiado lejos
-            self.path = path
-            return True
+        if path:
+            self.set_path(path)
+            return BT_SUCCESS
         else:
             return self.patrol()
 
 class Fygar(Enemy):
+    sprite_name = "fygar"
+    color = GREEN
+    
+    behavior_tree = BehaviorTree(BTSelector([
+        # Si está siendo bombeado, intentar huir
+        BTSequence([BTCondition("is_pumped"), BTAction("flee")]),
+        # Si puede lanzar fuego, prepararse
+        BTSequence([BTCondition("is_player_in_line"), BTAction("prepare_fire")]),
+        # Si el jugador está cerca, perseguirlo
+        BTSequence([BTCondition("is_player_nearby"), BTAction("chase_player")]),
+        # De lo contrario, patrullar
+        BTAction("patrol"),
+    ]))
+    
     def __init__(self, grid, player, x=None, y=None):
-        super().__init__(grid, player, x, y, GREEN)
+        super().__init__(grid, player, x, y)
         self.move_delay = 300  # Más lento
         self.fire_ready = True
         self.fire_cooldown = 0
         self.fire_direction = None
     
-    def create_behavior_tree(self):
-        return BTSelector([
-            # Si está siendo bombeado, intentar huir
-            BTSequence([
-                BTCondition(lambda actor: actor.pump_count > 0),
-                BTAction(lambda actor: actor.flee())
-            ]),
-            # Si puede lanzar fuego, prepararse
-            BTSequence([
-                BTCondition(lambda actor: actor.is_player_in_line()),
-                BTAction(lambda actor: actor.prepare_fire())
-            ]),
-            # Si el jugador está cerca, perseguirlo
-            BTSequence([
-                BTCondition(lambda actor: actor.is_player_nearby()),
-                BTAction(lambda actor: actor.chase_player())
-            ]),
-            # De lo contrario, patrullar
-            BTAction(lambda actor: actor.patrol())
-        ])
-    
     def is_player_in_line(self):
         # Comprobar si el jugador está en línea horizontal o vertical
-        dx = abs(self.player.grid_x - self.grid_x)
-        dy = abs(self.player.grid_y - self.grid_y)
+        board = self.blackboard
+        dx = abs(board.dx)
+        dy = abs(board.dy)
         
-        # Debe estar en línea y a una distancia razonable
+        # Debe estar en línea y a una distancia razonable, sin rocas en medio
         if (dx == 0 and 1 <= dy <= 4) or (dy == 0 and 1 <= dx <= 4):
-            # Verificar que no hay rocas en el camino
-            path_clear = True
-            if dx == 0:  # Vertical
-                step = 1 if self.player.grid_y > self.grid_y else -1
-                for y in range(self.grid_y + step, self.player.grid_y + step, step):
-                    if self.grid.is_rock(self.grid_x, y):
-                        path_clear = False
-                        break
-            else:  # Horizontal
-                step = 1 if self.player.grid_x > self.grid_x else -1
-                for x in range(self.grid_x + step, self.player.grid_x + step, step):
-                    if self.grid.is_rock(x, self.grid_y):
-                        path_clear = False
-                        break
-            
-            return path_clear and self.fire_ready
+            return self.fire_ready and board.line_clear
         
         return False
     
@@ -637,12 +2568,12 @@ class Fygar(Enemy):
         
         # Iniciar enfriamiento de la habilidad de fuego
         self.fire_ready = False
-        self.fire_cooldown = pygame.time.get_ticks() + 3000  # 3 segundos de enfriamiento
+        self.fire_cooldown = self.current_time + 3000  # 3 segundos de enfriamiento
         
-        return True
+        return BT_SUCCESS
     
-    def update(self, current_time):
-        result = super().update(current_time)
+    def update(self, current_time, think=True):
+        result = super().update(current_time, think)
         
         # Actualizar enfriamiento del fuego
         if not self.fire_ready and current_time > self.fire_cooldown:
@@ -650,59 +2581,226 @@ class Fygar(Enemy):
         
         return result
     
-    def draw(self, surface):
-        super().draw(surface)
+    def draw(self, surface, offset=(0, 0)):
+        dirty = super().draw(surface, offset)
         
         # Si está preparando fuego, dibujar indicador
         if self.state == "fire" and self.fire_direction:
-            fire_length = 3
-            dx, dy = self.fire_direction
-            start_x = self.rect.centerx
-            start_y = self.rect.centery
-            end_x = start_x + dx * TILE_SIZE * fire_length
-            end_y = start_y + dy * TILE_SIZE * fire_length
-            
-            pygame.draw.line(surface, (255, 0, 0), (start_x, start_y), (end_x, end_y), 4)
-            
-            # Dibujar llamas en el extremo
-            flame_rect = pygame.Rect(0, 0, TILE_SIZE // 2, TILE_SIZE // 2)
-            flame_rect.center = (end_x, end_y)
-            pygame.draw.rect(surface, (255, 165, 0), flame_rect)
+            frame, (offset_x, offset_y) = sprite_atlas.fire(self.fire_direction)
+            center_x, center_y = self.rect.move(offset).center
+            dirty.union_ip(surface.blit(frame, (center_x + offset_x, center_y + offset_y)))
+        
+        return dirty
+
+# Almacén opcional de enemigos en arrays paralelos (para cientos de enemigos).
+# Refleja la posición, el temporizador de movimiento, el retardo y los bombeos
+# de cada enemigo, en el mismo orden que Game.enemies; los enemigos lo
+# actualizan al cambiar. Así las comprobaciones de cada frame (distancia al
+# jugador y si toca moverse) se hacen en bloque, con NumPy si está instalado,
+# y los enemigos lejanos que no tienen nada que hacer ni se visitan.
+class EnemyStore:
+    def __init__(self):
+        self.enemies = []
+        self.xs = array("h")
+        self.ys = array("h")
+        self.move_timer = array("d")
+        self.move_delay = array("d")
+        self.pump_count = array("H")
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.np = numpy
+    
+    def __len__(self):
+        return len(self.enemies)
+    
+    def add(self, enemy):
+        enemy.store = self
+        enemy.store_slot = len(self.enemies)
+        self.enemies.append(enemy)
+        self.xs.append(enemy.grid_x)
+        self.ys.append(enemy.grid_y)
+        self.move_timer.append(enemy.move_timer)
+        self.move_delay.append(enemy.move_delay)
+        self.pump_count.append(enemy.pump_count)
+    
+    def remove(self, enemy):
+        slot = enemy.store_slot
+        del self.enemies[slot]
+        for column in (self.xs, self.ys, self.move_timer, self.move_delay, self.pump_count):
+            del column[slot]
+        for i in range(slot, len(self.enemies)):
+            self.enemies[i].store_slot = i
+        enemy.store = None
+        enemy.store_slot = None
+    
+    def batch(self, current_time, player):
+        # Distancia Manhattan al jugador y "le toca moverse" de cada enemigo
+        np = self.np
+        if np is not None and self.enemies:
+            xs = np.frombuffer(self.xs, dtype=np.int16)
+            ys = np.frombuffer(self.ys, dtype=np.int16)
+            distances = np.abs(xs - player.grid_x) + np.abs(ys - player.grid_y)
+            timers = np.frombuffer(self.move_timer)
+            due = current_time - timers > np.frombuffer(self.move_delay)
+            return distances.tolist(), due.tolist()
+        px, py = player.grid_x, player.grid_y
+        distances = [abs(x - px) + abs(y - py) for x, y in zip(self.xs, self.ys)]
+        due = [current_time - timer > delay for timer, delay in zip(self.move_timer, self.move_delay)]
+        return distances, due
+
+# Repetición de una partida: semilla + máscara de entradas de cada paso fijo.
+# Formato binario: cabecera (magia, versión, FPS, semilla, pasos) seguida de
+# las máscaras, un byte por paso, comprimidas con zlib.
+class Replay:
+    MAGIC = b"DDRP"
+    VERSION = 2
+    HEADER = struct.Struct("<4sBHQI")
+    MAP_SIZE = struct.Struct("<HH")  # Desde la versión 2; la 1 es siempre 25x19
+    SEEDS = range(2 ** 64)  # La cabecera guarda la semilla sin signo en 64 bits
+    
+    def __init__(self, seed, inputs=None, map_size=(GRID_WIDTH, GRID_HEIGHT)):
+        # Comprobarlo al empezar la partida, no al guardarla al final
+        if seed not in self.SEEDS:
+            raise ValueError(f"Semilla fuera de rango para una repetición: {seed}")
+        self.seed = seed
+        self.inputs = inputs if inputs is not None else bytearray()
+        self.map_size = tuple(map_size)
+    
+    def record(self, buttons):
+        self.inputs.append(buttons)
+    
+    def to_bytes(self):
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, FPS, self.seed, len(self.inputs))
+        header += self.MAP_SIZE.pack(*self.map_size)
+        return header + zlib.compress(bytes(self.inputs), 9)
+    
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, fps, seed, ticks = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version not in (1, cls.VERSION):
+            raise ValueError("No es una repetición de Dig Dug compatible")
+        if fps != FPS:
+            raise ValueError(f"Repetición grabada a {fps} FPS, el juego usa {FPS}")
+        offset = cls.HEADER.size
+        map_size = (GRID_WIDTH, GRID_HEIGHT)
+        if version >= 2:
+            map_size = cls.MAP_SIZE.unpack_from(data, offset)
+            offset += cls.MAP_SIZE.size
+        inputs = bytearray(zlib.decompress(data[offset:]))
+        if len(inputs) != ticks:
+            raise ValueError("Repetición truncada")
+        return cls(seed, inputs, map_size)
+    
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
 
 # Clase principal del juego
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False, seed=None, map_size=None):
         # Configuración inicial
-        self.grid = Grid()
-        self.menu = Menu()
+        # Sin ventana no se dibuja nada y la lógica avanza con step()
+        self.headless = headless
+        # Toda la aleatoriedad de la partida sale de este generador
+        self.seed = seed
+        self.rng = random.Random(seed)
+        # Mapa de 25x19 salvo que se pida otro tamaño (ancho, alto) en celdas;
+        # si no cabe en la ventana, la cámara sigue al jugador
+        self.grid = Grid(self.rng, *(map_size or (GRID_WIDTH, GRID_HEIGHT)))
         self.state = GameState.MENU
         self.player = None
         self.enemies = []
+        self.current_time = 0
+        self.ticks = 0
+        self.time_accumulator = 0  # Tiempo real pendiente de simular (ms)
+        self.recording = False  # Grabar una repetición de cada partida
+        self.replay = None
         self.last_enemy_spawn = 0
         self.enemy_spawn_delay = 10000  # 10 segundos entre enemigos
-        self.game_over_sound = load_sound("game_over.mp3")
-        self.win_sound = load_sound("win.mp3")
+        self.max_active_enemies = 5  # Enemigos simultáneos en pantalla
+        self.pooka_ratio = 0.7  # Proporción de Pookas frente a Fygars
+        # "astar": A* con caché y campo de distancias compartido para perseguir;
+        # "dstar": un planificador incremental D* Lite por enemigo;
+        # "hpa": A* jerárquico por clústeres. No es el de por defecto: sus
+        # caminos pueden ser algo más caros y cada excavación obliga a
+        # reconstruir el clúster del enemigo (en trozos, pero cada vez).
+        self.path_planner = "astar"
+        # Reparto del trabajo de IA entre frames (None: todo en cada frame)
+        self.ai_scheduler = AIScheduler()
+        # Procesos de búsqueda en segundo plano (0: ninguno). Las repeticiones
+        # dejan de ser deterministas: los caminos llegan cuando terminan.
+        self.path_workers = 0
+        self.path_pool = None
+        # Arrays paralelos para comprobar en bloque cientos de enemigos
+        self.use_entity_store = False
+        self.enemy_store = None
+        # Ajustes aplicados a cada jugador/enemigo nuevo, p. ej. {"move_delay": 200}
+        self.player_settings = {}
+        self.enemy_settings = {}
+        # Se decodifican en segundo plano mientras se muestra el menú
+        sound_bank.preload(["dig.mp3", "game_over.mp3", "win.mp3"])
+        self.game_over_sound = sound_bank.get("game_over.mp3")
+        self.win_sound = sound_bank.get("win.mp3")
         self.background_music = load_music("background_music.mp3")
         
         # Iniciar música de fondo
-        pygame.mixer.music.play(-1)
+        play_music(-1)
         
-        # Fuentes para texto
-        self.font = pygame.font.Font(None, 36)
-        self.big_font = pygame.font.Font(None, 72)
+        # Menú y fuentes para texto
+        if not headless:
+            self.menu = Menu()
+            self.font = pygame.font.Font(None, 36)
+            self.big_font = pygame.font.Font(None, 72)
+            self.hud = Hud(self.font)
+            self.camera = Camera(WIDTH, HEIGHT, self.grid.pixel_rect())
         
         # Objetivos del juego
         self.max_score = 500  # Puntuación para ganar
         self.max_enemies = 10  # Número máximo de enemigos a derrotar
         self.enemies_defeated = 0
+        
+        # Dibujado por zonas sucias: None significa actualizar la pantalla entera
+        self.dirty_rects = None
+        self.sprite_rects = []  # Zonas ocupadas por sprites y HUD en el frame anterior
+        self.full_redraw = True
     
-    def reset_game(self):
-        # Reiniciar el juego
+    def reset_game(self, seed=None):
+        # Reiniciar el juego con una semilla nueva (o la indicada, para repetir)
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(32) if self.seed is None else self.seed
+        self.seed = None  # La semilla del constructor solo vale para la primera partida
+        self.rng.seed(seed)
+        self.game_seed = seed
+        self.replay = Replay(seed, map_size=(self.grid.width, self.grid.height)) if self.recording else None
+        self.ticks = 0
+        self.current_time = 0
+        self.time_accumulator = 0
+        if self.ai_scheduler is not None:
+            self.ai_scheduler.clear()
+            large = len(self.grid.cells) > Grid.EAGER_TABLE_CELLS
+            self.ai_scheduler.node_cost = AIScheduler.LARGE_MAP_NODE_COST if large else 1
+            if self.path_workers > 0 and self.path_pool is None:
+                self.path_pool = PathWorkerPool(self.grid, self.path_workers)
+                self.ai_scheduler.pool = self.path_pool
+        
         self.grid.reset()
         self.player = Player(self.grid)
+        for name, value in self.player_settings.items():
+            setattr(self.player, name, value)
         self.enemies = []
-        self.last_enemy_spawn = pygame.time.get_ticks()
+        self.enemy_store = EnemyStore() if self.use_entity_store else None
+        self.last_enemy_spawn = self.current_time
         self.enemies_defeated = 0
+        self.full_redraw = True
+        if not self.headless:
+            self.camera.center_on(self.player.rect)
         
         # Añadir enemigos iniciales
         self.add_enemy()
@@ -710,11 +2808,21 @@ class Game:
     
     def add_enemy(self):
         # 70% probabilidad de Pooka, 30% de Fygar
-        if len(self.enemies) < 5:  # Limitar número máximo de enemigos simultáneos
-            if random.random() < 0.7:
-                self.enemies.append(Pooka(self.grid, self.player))
+        if len(self.enemies) < self.max_active_enemies:  # Limitar número máximo de enemigos simultáneos
+            if self.rng.random() < self.pooka_ratio:
+                enemy = Pooka(self.grid, self.player)
             else:
-                self.enemies.append(Fygar(self.grid, self.player))
+                enemy = Fygar(self.grid, self.player)
+            if self.path_planner == "dstar":
+                enemy.planner = DStarLite(self.grid)
+            elif self.path_planner == "hpa":
+                enemy.pathfinder = HPAStar(self.grid)
+            enemy.scheduler = self.ai_scheduler
+            for name, value in self.enemy_settings.items():
+                setattr(enemy, name, value)
+            self.enemies.append(enemy)
+            if self.enemy_store is not None:
+                self.enemy_store.add(enemy)
     
     def handle_menu(self, events):
         for event in events:
@@ -723,51 +2831,122 @@ class Game:
                     self.state = GameState.GAME
                     self.reset_game()
                 elif event.key == pygame.K_ESCAPE:
-                    pygame.quit()
-                    sys.exit()
+                    self.running = False  # run() cierra el juego al acabar el frame
         
         # Dibujar menú
         self.menu.draw(screen)
     
-    def handle_game(self, events, current_time):
+    def handle_game(self, events, elapsed):
         # Procesar eventos
         for event in events:
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     self.state = GameState.MENU
         
+        # Paso fijo: la lógica avanza de TICK_MS en TICK_MS sea cual sea la
+        # duración del frame, así la partida se puede repetir exactamente
+        self.time_accumulator = min(self.time_accumulator + elapsed,
+                                    TICK_MS * MAX_STEPS_PER_FRAME)
+        buttons = read_keyboard()
+        while self.time_accumulator >= TICK_MS and self.state == GameState.GAME:
+            self.time_accumulator -= TICK_MS
+            self.step(buttons)
+        
+        # Dibujar
+        self.draw_game()
+    
+    def start(self, seed=None):
+        # Empezar una partida directamente, sin pasar por el menú
+        self.state = GameState.GAME
+        self.reset_game(seed)
+    
+    def step(self, buttons=0):
+        # Avanzar la partida un paso fijo de TICK_MS con las entradas dadas
+        if self.replay is not None:
+            self.replay.record(buttons)
+        self.ticks += 1
+        self.update_game(self.ticks * TICK_MS, buttons)
+        return self.state
+    
+    def play_replay(self, replay):
+        # Reproducir una repetición sin esperar al reloj real
+        if replay.map_size != (self.grid.width, self.grid.height):
+            raise ValueError(f"Repetición grabada en un mapa de {replay.map_size[0]}x{replay.map_size[1]}")
+        self.start(replay.seed)
+        for buttons in replay.inputs:
+            if self.state != GameState.GAME:
+                break
+            self.step(buttons)
+        return self.state
+    
+    def simulate(self, controller, max_ticks):
+        # Jugar hasta ganar, perder o agotar `max_ticks`.
+        # `controller(game)` devuelve la máscara de entradas de cada paso.
+        for _ in range(max_ticks):
+            if self.state != GameState.GAME:
+                break
+            self.step(controller(self))
+        return self.state
+    
+    def update_game(self, current_time, buttons):
+        self.current_time = current_time
+        
         # Actualizar jugador
-        self.player.update(current_time)
-        self.player.pump(self.enemies)
+        started = profiler.start()
+        self.player.update(current_time, buttons)
+        self.player.pump(self.enemies, buttons)
+        profiler.stop("player.update", started)
         
         # Actualizar enemigos y comprobar colisiones
+        scheduler = self.ai_scheduler
+        if scheduler is not None:
+            scheduler.begin_frame(self.ticks)
+        store = self.enemy_store
+        if store is not None:
+            distances, due = store.batch(current_time, self.player)
         enemies_to_remove = []
         for i, enemy in enumerate(self.enemies):
             # Actualizar enemigo
-            if enemy.update(current_time):
+            if store is None:
+                think = scheduler is None or scheduler.should_think(enemy, i)
+            else:
+                think = scheduler is None or scheduler.should_think(enemy, i, distances[i])
+                if not think and not due[i]:
+                    continue  # Sin pensar ni moverse, update() no haría nada
+            if enemy.update(current_time, think):
                 enemies_to_remove.append(i)
                 self.enemies_defeated += 1
                 self.player.score += 100
-            
-            # Comprobar colisión con el jugador (si no está siendo bombeado)
-            if (enemy.pump_count == 0 and 
-                enemy.grid_x == self.player.grid_x and 
-                enemy.grid_y == self.player.grid_y):
-                self.player.lives -= 1
-                if self.player.lives <= 0:
-                    self.state = GameState.GAME_OVER
-                    self.game_over_sound.play()
-                else:
-                    # Reposicionar al jugador
-                    self.player.grid_x = GRID_WIDTH // 2
-                    self.player.grid_y = 1
-                    self.player.rect.centerx = self.player.grid_x * TILE_SIZE + TILE_SIZE // 2
-                    self.player.rect.centery = self.player.grid_y * TILE_SIZE + TILE_SIZE // 2
         
         # Eliminar enemigos derrotados
         for i in sorted(enemies_to_remove, reverse=True):
+            if scheduler is not None:
+                scheduler.cancel(self.enemies[i])
+            self.grid.occupancy.remove(self.enemies[i])
+            if store is not None:
+                store.remove(self.enemies[i])
             del self.enemies[i]
         
+        # Comprobar colisión con el jugador (si el enemigo no está siendo bombeado)
+        occupants = self.grid.occupancy.at(self.player.grid_x, self.player.grid_y)
+        if any(enemy.pump_count == 0 for enemy in occupants):
+            self.player.lives -= 1
+            if self.player.lives <= 0:
+                self.state = GameState.GAME_OVER
+                self.game_over_sound.play()
+            else:
+                # Reposicionar al jugador
+                self.player.grid_x = self.grid.width // 2
+                self.player.grid_y = 1
+                self.player.rect.centerx = self.player.grid_x * TILE_SIZE + TILE_SIZE // 2
+                self.player.rect.centery = self.player.grid_y * TILE_SIZE + TILE_SIZE // 2
+        
+        # Continuar las búsquedas pendientes con el presupuesto que quede
+        if scheduler is not None:
+            started = profiler.start()
+            scheduler.run()
+            profiler.stop("ai.scheduler", started)
+        
         # Generar nuevos enemigos
         if current_time - self.last_enemy_spawn > self.enemy_spawn_delay:
             self.add_enemy()
@@ -777,9 +2956,6 @@ class Game:
         if self.player.score >= self.max_score or self.enemies_defeated >= self.max_enemies:
             self.state = GameState.WIN
             self.win_sound.play()
-        
-        # Dibujar
-        self.draw_game()
     
     def handle_game_over(self, events):
         for event in events:
@@ -787,14 +2963,13 @@ class Game:
                 if event.key == pygame.K_RETURN:
                     self.state = GameState.MENU
                 elif event.key == pygame.K_ESCAPE:
-                    pygame.quit()
-                    sys.exit()
+                    self.running = False  # run() cierra el juego al acabar el frame
         
         # Dibujar pantalla de game over
         screen.fill(BLACK)
-        game_over_text = self.big_font.render("GAME OVER", True, RED)
-        score_text = self.font.render(f"Puntuación: {self.player.score}", True, WHITE)
-        restart_text = self.font.render("Presiona ENTER para volver al menú", True, WHITE)
+        game_over_text = text_cache.render(self.big_font, "GAME OVER", RED)
+        score_text = text_cache.render(self.font, f"Puntuación: {self.player.score}", WHITE)
+        restart_text = text_cache.render(self.font, "Presiona ENTER para volver al menú", WHITE)
         
         screen.blit(game_over_text, game_over_text.get_rect(center=(WIDTH // 2, HEIGHT // 3)))
         screen.blit(score_text, score_text.get_rect(center=(WIDTH // 2, HEIGHT // 2)))
@@ -806,67 +2981,184 @@ class Game:
                 if event.key == pygame.K_RETURN:
                     self.state = GameState.MENU
                 elif event.key == pygame.K_ESCAPE:
-                    pygame.quit()
-                    sys.exit()
+                    self.running = False  # run() cierra el juego al acabar el frame
         
         # Dibujar pantalla de victoria
         screen.fill(BLACK)
-        win_text = self.big_font.render("¡VICTORIA!", True, GREEN)
-        score_text = self.font.render(f"Puntuación: {self.player.score}", True, WHITE)
-        restart_text = self.font.render("Presiona ENTER para volver al menú", True, WHITE)
+        win_text = text_cache.render(self.big_font, "¡VICTORIA!", GREEN)
+        score_text = text_cache.render(self.font, f"Puntuación: {self.player.score}", WHITE)
+        restart_text = text_cache.render(self.font, "Presiona ENTER para volver al menú", WHITE)
         
         screen.blit(win_text, win_text.get_rect(center=(WIDTH // 2, HEIGHT // 3)))
         screen.blit(score_text, score_text.get_rect(center=(WIDTH // 2, HEIGHT // 2)))
         screen.blit(restart_text, restart_text.get_rect(center=(WIDTH // 2, HEIGHT * 2 // 3)))
     
     def draw_game(self):
-        # Dibujar fondo y grid
-        screen.fill(BLACK)
-        self.grid.draw(screen)
+        # Dibujar fondo y grid. El terreno está pre-renderizado por trozos: si no
+        # hace falta redibujar todo (ni la cámara se ha movido), basta con
+        # restaurarlo bajo los sprites del frame anterior y bajo las celdas
+        # excavadas desde entonces. Solo se dibuja lo que cae en la vista.
+        started = profiler.start()
+        camera = self.camera
+        scrolled = camera.follow(self.player.rect)
+        offset = camera.offset
+        terrain_rects = self.grid.refresh_surface()
+        border = not camera.world.contains(camera.rect)  # Mapa más pequeño que la ventana
+        if self.full_redraw or scrolled:
+            if border:
+                screen.fill(BLACK)
+            self.grid.draw(screen, camera.rect)
+            dirty = None
+        else:
+            screen_rect = screen.get_rect()
+            dirty = []
+            for rect in [rect.move(offset) for rect in terrain_rects] + self.sprite_rects:
+                rect = rect.clip(screen_rect)
+                if border:
+                    screen.fill(BLACK, rect)
+                self.grid.draw(screen, camera.rect, rect)
+                dirty.append(rect)
+        profiler.stop("grid.draw", started)
         
-        # Dibujar jugador y enemigos
-        self.player.draw(screen)
+        # Dibujar jugador y enemigos visibles (con margen para el fuego de Fygar)
+        sprite_rects = [self.player.draw(screen, offset)]
+        margin = 2 * SpriteAtlas.FIRE_LENGTH * TILE_SIZE
+        visible = camera.rect.inflate(margin, margin)
         for enemy in self.enemies:
-            enemy.draw(screen)
+            if visible.colliderect(enemy.rect):
+                sprite_rects.append(enemy.draw(screen, offset))
         
         # Dibujar HUD (información del jugador)
-        score_text = self.font.render(f"Puntuación: {self.player.score}", True, WHITE)
-        lives_text = self.font.render(f"Vidas: {self.player.lives}", True, WHITE)
-        enemies_text = self.font.render(f"Enemigos: {self.enemies_defeated}/{self.max_enemies}", True, WHITE)
+        started = profiler.start()
+        self.hud.update(self.player.score, self.player.lives, self.enemies_defeated, self.max_enemies)
+        sprite_rects.extend(self.hud.draw(screen))
+        profiler.stop("hud.render", started)
         
-        screen.blit(score_text, (10, 10))
-        screen.blit(lives_text, (10, 50))
-        screen.blit(enemies_text, (WIDTH - 200, 10))
+        # Panel de perfilado encima de todo (F3)
+        if profiler.overlay:
+            sprite_rects.append(profiler.draw(screen))
+        
+        self.sprite_rects = sprite_rects
+        if dirty is not None:
+            dirty.extend(sprite_rects)
+        self.dirty_rects = dirty
+        self.full_redraw = False
     
-    def run(self):
+    def run(self, replay_path=None, profile_path=None, first_frame_only=False):
         # Bucle principal del juego
-        running = True
-        while running:
-            current_time = pygame.time.get_ticks()
-            events = pygame.event.get()
-            
-            for event in events:
-                if event.type == pygame.QUIT:
-                    running = False
-            
-            # Manejar estados del juego
-            if self.state == GameState.MENU:
-                self.handle_menu(events)
-            elif self.state == GameState.GAME:
-                self.handle_game(events, current_time)
-            elif self.state == GameState.GAME_OVER:
-                self.handle_game_over(events)
-            elif self.state == GameState.WIN:
-                self.handle_win(events)
+        # Con `replay_path` se guarda la repetición de la última partida jugada
+        # y con `profile_path` las medidas del perfilador (JSON + traza de Chrome).
+        # `first_frame_only` sale tras el primer frame (medir el arranque).
+        self.recording = replay_path is not None
+        if profile_path:
+            profiler.enable()
+        open_window()
+        sprite_atlas.preload((Pooka, Fygar))
+        self.running = True
+        elapsed = 0
+        try:
+            while self.running:
+                frame_started = profiler.begin_frame()
+                events = pygame.event.get()
+                
+                for event in events:
+                    if event.type == pygame.QUIT:
+                        self.running = False
+                    elif event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_F3:
+                            # Mostrar u ocultar el panel de perfilado
+                            profiler.overlay = not profiler.overlay
+                            profiler.enable(profiler.overlay or bool(profile_path))
+                            self.full_redraw = True
+                        elif event.key == pygame.K_F4 and profiler.enabled:
+                            self.export_profile(profile_path or "profile")
+                
+                # Manejar estados del juego
+                if self.state == GameState.MENU:
+                    self.handle_menu(events)
+                elif self.state == GameState.GAME:
+                    self.handle_game(events, elapsed)
+                elif self.state == GameState.GAME_OVER:
+                    self.handle_game_over(events)
+                elif self.state == GameState.WIN:
+                    self.handle_win(events)
+                
+                # Actualizar pantalla: solo las zonas sucias si el estado las calculó
+                started = profiler.start()
+                if self.dirty_rects is not None:
+                    pygame.display.update(self.dirty_rects)
+                else:
+                    pygame.display.flip()
+                profiler.stop("display.flip", started)
+                self.dirty_rects = None
+                profiler.end_frame(frame_started)
+                if profiler.first_frame_ms is None:
+                    profiler.first_frame_ms = (time.perf_counter() - STARTUP_TIME) * 1000
+                    if first_frame_only:
+                        print(f"Primer frame en {profiler.first_frame_ms:.1f} ms")
+                        self.running = False
+                elapsed = clock.tick(FPS)
             
-            # Actualizar pantalla
-            pygame.display.flip()
-            clock.tick(FPS)
-        
-        pygame.quit()
+            if self.replay is not None:
+                self.replay.save(replay_path)
+            if profile_path:
+                self.export_profile(profile_path)
+        finally:
+            # También al salir con ESC o por una excepción: cerrar los procesos
+            # de búsqueda y liberar la memoria compartida
+            self.shutdown()
+            pygame.quit()
+    
+    def shutdown(self):
+        if self.path_pool is not None:
+            self.path_pool.shutdown()
+            self.path_pool = None
+            self.ai_scheduler.pool = None
+    
+    def export_profile(self, path):
+        # Escribe <path>.json (por frame y medias) y <path>.trace.json (Chrome)
+        base = os.path.splitext(path)[0]
+        profiler.export(base + ".json", base + ".trace.json")
+
+# Línea de órdenes
+def main_cli(argv=None):
+    import argparse
+    
+    def seed_type(text):
+        seed = int(text)
+        if seed not in Replay.SEEDS:
+            raise argparse.ArgumentTypeError(f"la semilla debe estar entre 0 y {Replay.SEEDS[-1]}")
+        return seed
+    
+    parser = argparse.ArgumentParser(description="Dig Dug con IA")
+    parser.add_argument("--seed", type=seed_type, help="Semilla de la primera partida")
+    parser.add_argument("--record", metavar="FICHERO", help="Guardar la repetición de la última partida")
+    parser.add_argument("--replay", metavar="FICHERO", help="Reproducir una repetición sin ventana y mostrar el resultado")
+    parser.add_argument("--profile", metavar="FICHERO", help="Medir cada frame y guardar el perfil al salir (F3: panel, F4: exportar)")
+    parser.add_argument("--path-workers", type=int, default=0, metavar="N",
+                        help="Buscar caminos en N procesos en segundo plano (sin repeticiones deterministas)")
+    parser.add_argument("--map", metavar="ANCHOxALTO", help="Tamaño del mapa en celdas, p. ej. 1000x1000")
+    parser.add_argument("--no-audio", action="store_true", help="No iniciar el sonido")
+    parser.add_argument("--first-frame", action="store_true",
+                        help="Mostrar el tiempo desde el arranque hasta el primer frame y salir")
+    args = parser.parse_args(argv)
+    
+    if args.replay:
+        replay = Replay.load(args.replay)
+        game = Game(headless=True, map_size=replay.map_size)
+        state = game.play_replay(replay)
+        print(f"{state.name}: {game.player.score} puntos, {game.enemies_defeated} enemigos, "
+              f"{game.player.lives} vidas, {game.ticks} pasos")
+    else:
+        init_pygame(audio=not args.no_audio)
+        map_size = tuple(int(n) for n in args.map.lower().split("x")) if args.map else None
+        game = Game(seed=args.seed, map_size=map_size)
+        game.path_workers = args.path_workers
+        game.run(args.record, args.profile, args.first_frame)
 
-# Iniciar el juego
+# Iniciar el juego. Ejecutado como script, Python no guarda el bytecode de
+# este fichero; `python -c "import main; main.main_cli()"` sí lo reutiliza
+# y arranca antes.
 if __name__ == "__main__":
-    game = Game()
-    game.run()
+    main_cli()
         